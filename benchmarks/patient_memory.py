@@ -0,0 +1,149 @@
+"""
+Память, которую занимают восстановленные пациенты.
+slots - текущее представление PatientUser (слоты, минуты дня, общие
+Location), dict - прежнее представление на словарях (воспроизводится
+здесь же), both - оба замера и их сравнение.
+Запуск: python -m benchmarks.patient_memory [-n 100000]
+        [--layout both|slots|dict]
+"""
+import argparse
+import base64
+import datetime as dt
+import gc
+import os
+import re
+import time
+import tracemalloc
+
+import pytz
+
+# Бд для бенчмарка не нужна, но users_classes подключается к ней при импорте
+os.environ.setdefault('DB_ADDRESS',
+                      base64.b64encode(b'sqlite://').decode('utf-8'))
+
+
+def patient_data(i: int) -> dict:
+    return {
+        'code': f'034ASDQWE{i}',
+        'tz_str': f'Etc/GMT{"-" if i % 2 else "+"}{i % 11}',
+        'times': {'MOR': dt.time(8, i % 60), 'EVE': dt.time(20, i % 60)},
+        'accept_times': {'MOR': 2 * i + 1, 'EVE': 2 * i + 2},
+    }
+
+
+def build_patients(n: int) -> list:
+    from modules.users_classes import PatientUser
+
+    patients = []
+    for i in range(n):
+        p = PatientUser(10 ** 9 + i)
+        p.restore(**patient_data(i))
+        patients.append(p)
+    return patients
+
+
+class DictLocation:
+    """Location до перехода на слоты: свой объект у каждого пациента"""
+
+    def __init__(self, tz=None, location: dict = None):
+        self._time_zone = tz
+        self._location = location
+
+
+class DictPatientTimes:
+    """PatientTimes до перехода на слоты: словари datetime"""
+
+    def __init__(self, times):
+        from modules.users_classes import PatientTimes
+
+        self.times = {k: PatientTimes.default_times[k].replace(
+            hour=times[k].hour, minute=times[k].minute) for k in times}
+        self.orig_t = self.times.copy()
+
+
+class DictPatientLocation:
+    def __init__(self, tz):
+        self.tz = tz
+        self.location = self.orig_loc = DictLocation(tz=-int(re.search(
+            pattern=r'[+-]?\d+', string=tz.zone).group(0)))
+
+
+class DictPatientUser:
+    """Атрибуты PatientUser до перехода на слоты (без поведения)"""
+
+    def __init__(self, chat_id: int, code, tz_str, times, accept_times):
+        self.chat_id = chat_id
+        self.code = code
+        self.is_registered = True
+        self.member = True
+        self.doctor_id = None
+        self.p_loc = DictPatientLocation(pytz.timezone(tz_str))
+        self.times = DictPatientTimes(times)
+        self.accept_times = dict(accept_times)
+        self.msg_to_del = self.active_dialog_msg = None
+        self.alarmed = {'MOR': False, 'EVE': False}
+        self.curr_state = ['MOR', 0]
+        self.pill_response = None
+        self.data_response = {'sys': None, 'dias': None, 'heart': None}
+
+
+def build_dict_patients(n: int) -> list:
+    # Как и restore, пациенты хранятся в словаре по chat_id
+    registry = {}
+    for i in range(n):
+        chat_id = 10 ** 9 + i
+        registry[chat_id] = DictPatientUser(chat_id, **patient_data(i))
+    return list(registry.values())
+
+
+def measure(build, n: int) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    start = time.perf_counter()
+    patients = build(n)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    total = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return {'patients': len(patients), 'total': total,
+            'per_patient': total / len(patients), 'build': elapsed}
+
+
+def report(name: str, result: dict) -> None:
+    print(f'{name}: patients: {result["patients"]}, '
+          f'total: {result["total"] / 2 ** 20:.1f} MiB, '
+          f'per patient: {result["per_patient"]:.0f} bytes, '
+          f'build: {result["build"]:.2f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=100_000,
+                        help='number of patients')
+    parser.add_argument('--layout', choices=('both', 'slots', 'dict'),
+                        default='both', help='patient representation')
+    args = parser.parse_args()
+
+    # Импорты и ленивые таблицы не должны попасть в замер
+    build_patients(1)
+    build_dict_patients(1)
+    from modules.users_list import users_list
+    users_list.clear()
+
+    results = {}
+    if args.layout in ('both', 'dict'):
+        results['dict'] = measure(build_dict_patients, args.n)
+        report('dict', results['dict'])
+    if args.layout in ('both', 'slots'):
+        results['slots'] = measure(build_patients, args.n)
+        report('slots', results['slots'])
+    if len(results) == 2:
+        ratio = results['slots']['total'] / results['dict']['total']
+        print(f'slots / dict: {ratio:.2f}')
+
+
+if __name__ == '__main__':
+    main()
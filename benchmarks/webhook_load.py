@@ -0,0 +1,167 @@
+"""
+Нагрузка на вебхук: отправка синтетических обновлений на сервер вебхука.
+Без --url поднимается локальный сервер вебхука (tornado из
+python-telegram-bot) с диспетчером, как в main.py, но вместо диалогов бота
+обновления обрабатывает пустой обработчик (--work-ms - время обработки).
+Запуск: python -m benchmarks.webhook_load [-n 5000] [-c 16] [--workers 8]
+        [--queue-size 0] [--work-ms 0] [--url http://host:port/webhook]
+"""
+import argparse
+import itertools
+import statistics
+import threading
+import time
+from queue import Queue
+
+import requests
+from telegram import Update, User
+from telegram.ext import Dispatcher, ExtBot, TypeHandler
+from telegram.ext.utils.webhookhandler import WebhookAppClass, WebhookServer
+
+# Обновления без обращений к Telegram API, токен не проверяется
+TOKEN = '123:ABC'
+
+
+def make_update(update_id: int, users: int) -> dict:
+    chat_id = 10 ** 9 + update_id % users
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'load'},
+            'text': 'Справка',
+        }
+    }
+
+
+class LocalWebhook:
+    """Сервер вебхука и диспетчер в текущем процессе"""
+
+    def __init__(self, port: int, workers: int, queue_size: int,
+                 work_ms: float):
+        self.processed = 0
+        self.done = threading.Event()
+        self.expected = None
+        self._lock = threading.Lock()
+        self._work = work_ms / 1000
+
+        bot = ExtBot(TOKEN)
+        # Диспетчер запрашивает getMe при запуске потоков
+        bot._bot = User(id=123, first_name='load', is_bot=True,
+                        username='load_bot')
+        self.update_queue = Queue(maxsize=queue_size)
+        self.dispatcher = Dispatcher(bot, self.update_queue, workers=workers,
+                                     use_context=True)
+        self.dispatcher.add_handler(TypeHandler(Update, self.handle,
+                                                run_async=True))
+        self.server = WebhookServer(
+            '127.0.0.1', port, WebhookAppClass('/webhook', bot,
+                                               self.update_queue), None)
+        self.url = f'http://127.0.0.1:{port}/webhook'
+
+    def handle(self, update, context):
+        if self._work:
+            time.sleep(self._work)
+        with self._lock:
+            self.processed += 1
+            if self.processed == self.expected:
+                self.done.set()
+
+    def start(self):
+        ready = threading.Event()
+        threading.Thread(target=self.dispatcher.start, daemon=True).start()
+        threading.Thread(target=self.server.serve_forever, args=(ready,),
+                         daemon=True).start()
+        ready.wait()
+
+    def stop(self):
+        self.server.shutdown()
+        self.dispatcher.stop()
+
+
+def post_updates(url: str, n: int, concurrency: int, users: int) -> list:
+    """Отправляем n обновлений в concurrency потоков,
+    возвращаем время ответа на каждый запрос"""
+    ids = itertools.count(1)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        session = requests.Session()
+        while (update_id := next(ids)) <= n:
+            start = time.perf_counter()
+            try:
+                response = session.post(url, json=make_update(update_id,
+                                                              users),
+                                        timeout=30)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                with lock:
+                    errors.append(e)
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        print(f'errors: {len(errors)} (first: {errors[0]})')
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=5000,
+                        help='number of updates')
+    parser.add_argument('-c', type=int, default=16,
+                        help='concurrent connections')
+    parser.add_argument('--users', type=int, default=1000,
+                        help='number of distinct chats')
+    parser.add_argument('--url', help='webhook of a running bot '
+                                      '(default: local server)')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--workers', type=int, default=8,
+                        help='dispatcher workers (local server)')
+    parser.add_argument('--queue-size', type=int, default=0,
+                        help='update queue size, 0 - unbounded '
+                             '(local server)')
+    parser.add_argument('--work-ms', type=float, default=0,
+                        help='handler time per update (local server)')
+    args = parser.parse_args()
+
+    local = None
+    url = args.url
+    if url is None:
+        local = LocalWebhook(args.port, args.workers, args.queue_size,
+                             args.work_ms)
+        local.expected = args.n
+        local.start()
+        url = local.url
+
+    start = time.perf_counter()
+    latencies = post_updates(url, args.n, args.c, args.users)
+    posted = time.perf_counter() - start
+    print(f'posted: {len(latencies)} in {posted:.2f}s '
+          f'({len(latencies) / posted:.0f} updates/s)')
+    if latencies:
+        latencies.sort()
+        print(f'latency: avg {statistics.mean(latencies) * 1000:.1f}ms, '
+              f'p50 {latencies[len(latencies) // 2] * 1000:.1f}ms, '
+              f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms')
+
+    if local is not None:
+        local.done.wait(60)
+        processed = time.perf_counter() - start
+        print(f'processed: {local.processed} in {processed:.2f}s '
+              f'({local.processed / processed:.0f} updates/s)')
+        local.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1 @@
-from . import accept_time, patient, doctor, record, region, university
+from . import accept_time, alarm, patient, doctor, record, region, university
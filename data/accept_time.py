@@ -11,8 +11,14 @@ class AcceptTime(SqlAlchemyBase):
                            primary_key=True)
     patient_id = sqlalchemy.Column(sqlalchemy.Integer,
                                    sqlalchemy.ForeignKey('patient.id',
-                                                         ondelete='CASCADE'))
+                                                         ondelete='CASCADE'),
+                                   index=True)
     time = sqlalchemy.Column(sqlalchemy.Time)
+    # Обновляются вместе с добавлением записей (db_api.write_batch):
+    # время последнего ответа с данными давления и количество записей
+    last_response_at = sqlalchemy.Column(sqlalchemy.DateTime)
+    record_count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False,
+                                     default=0, server_default='0')
     record = orm.relationship('Record', back_populates='accept_time',
                               passive_deletes='all')
     patient = orm.relation('Patient')
@@ -0,0 +1,28 @@
+import sqlalchemy
+
+from .db_session import SqlAlchemyBase
+
+
+class Alarm(SqlAlchemyBase):
+    """Отправленные оповещения врачу/региону о пациенте без ответа"""
+    __tablename__ = 'alarm'
+    # Одно оповещение каждого типа о пациенте в день
+    __table_args__ = (
+        sqlalchemy.UniqueConstraint('chat_id', 'kind', 'day',
+                                    name='uq_alarm_chat_id_kind_day'),
+    )
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, autoincrement=True,
+                           primary_key=True)
+    chat_id = sqlalchemy.Column(sqlalchemy.BIGINT,
+                                sqlalchemy.ForeignKey('patient.chat_id',
+                                                      ondelete='CASCADE'))
+    # doctor или region
+    kind = sqlalchemy.Column(sqlalchemy.String(10))
+    # День по часовому поясу пациента
+    day = sqlalchemy.Column(sqlalchemy.Date, index=True)
+    days = sqlalchemy.Column(sqlalchemy.Integer)
+    sent_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    def __repr__(self):
+        return f'{self.chat_id} - {self.kind} - {self.day}'
@@ -1,10 +1,12 @@
 import logging
+import threading
+import time
 
 import sqlalchemy as sa
 import sqlalchemy.ext.declarative as dec
 import sqlalchemy.orm as orm
 from sqlalchemy.orm import Session
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import NullPool, QueuePool
 
 from tools.tools import get_from_env
 
@@ -15,10 +17,95 @@ SqlAlchemyBase = dec.declarative_base()
 
 
 __factory = None
+__engine = None
+
+
+class PoolStats:
+    """Счетчики выдачи соединений из пула"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def on_connect(self, *args):
+        with self._lock:
+            self.connects += 1
+
+    def on_checkout(self, *args):
+        with self._lock:
+            self.checkouts += 1
+
+    def on_checkin(self, *args):
+        with self._lock:
+            self.checkins += 1
+
+    def add_wait(self, seconds: float):
+        with self._lock:
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checked_out': self.checkouts - self.checkins,
+                'wait_avg_ms': round(self.wait_total / self.checkouts * 1000,
+                                     3) if self.checkouts else 0.0,
+                'wait_max_ms': round(self.wait_max * 1000, 3),
+            }
+
+
+pool_stats = PoolStats()
+
+
+class StatQueuePool(QueuePool):
+    """QueuePool, который замеряет время ожидания свободного соединения"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_stats.add_wait(time.perf_counter() - start)
+
+
+def _engine_kwargs() -> dict:
+    """Настройки пула соединений из .env.
+    DB_POOL_MODE: queue (по умолчанию) - переиспользуемые соединения,
+    null - новое соединение на каждую сессию"""
+    mode = get_from_env('DB_POOL_MODE', 'queue').lower()
+    if mode == 'null':
+        return {'poolclass': NullPool}
+    if mode != 'queue':
+        raise ValueError(f'Unknown DB_POOL_MODE: {mode}')
+    return {
+        'poolclass': StatQueuePool,
+        'pool_size': int(get_from_env('DB_POOL_SIZE', '10')),
+        'max_overflow': int(get_from_env('DB_MAX_OVERFLOW', '20')),
+        'pool_timeout': float(get_from_env('DB_POOL_TIMEOUT', '30')),
+        # MySQL закрывает простаивающие соединения (wait_timeout),
+        # поэтому пересоздаем их заранее и проверяем перед выдачей
+        'pool_recycle': int(get_from_env('DB_POOL_RECYCLE', '3600')),
+        'pool_pre_ping': get_from_env('DB_POOL_PRE_PING', 'true').lower()
+        in ('1', 'true', 'yes'),
+    }
+
+
+def _enable_foreign_keys(connection, record):
+    # sqlite не проверяет внешние ключи и не удаляет зависимые строки
+    # (ondelete='CASCADE'), пока это не включено для соединения
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
 
 
 def global_init():
-    global __factory
+    global __factory, __engine
 
     if __factory:
         return
@@ -27,7 +114,19 @@ def global_init():
     conn_str = db_address
 
     logging.info(f"Подключение к базе данных по адресу {conn_str}")
-    engine = sa.create_engine(conn_str, echo=False, poolclass=NullPool)
+    kwargs = _engine_kwargs()
+    if conn_str.startswith('sqlite'):
+        # Соединения из пула используются разными потоками
+        kwargs['connect_args'] = {'check_same_thread': False}
+    engine = sa.create_engine(conn_str, echo=False, **kwargs)
+    if conn_str.startswith('sqlite'):
+        sa.event.listen(engine, 'connect', _enable_foreign_keys)
+    sa.event.listen(engine.pool, 'connect', pool_stats.on_connect)
+    sa.event.listen(engine.pool, 'checkout', pool_stats.on_checkout)
+    sa.event.listen(engine.pool, 'checkin', pool_stats.on_checkin)
+    logging.info(f'Пул соединений: {kwargs["poolclass"].__name__}')
+
+    __engine = engine
     __factory = orm.sessionmaker(bind=engine, expire_on_commit=False)
 
     from . import __all_models
@@ -38,3 +137,16 @@ def global_init():
 def create_session() -> Session:
     global __factory
     return __factory()
+
+
+def get_engine():
+    global __engine
+    return __engine
+
+
+def pool_status() -> dict:
+    """Состояние пула и статистика выдачи соединений"""
+    status = pool_stats.as_dict()
+    if __engine is not None:
+        status['pool'] = __engine.pool.status()
+    return status
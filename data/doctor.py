@@ -8,8 +8,8 @@ class Doctor(SqlAlchemyBase):
 
     id = sqlalchemy.Column(sqlalchemy.Integer, autoincrement=True,
                            primary_key=True)
-    chat_id = sqlalchemy.Column(sqlalchemy.BIGINT)
-    doctor_code = sqlalchemy.Column(sqlalchemy.String(7))
+    chat_id = sqlalchemy.Column(sqlalchemy.BIGINT, index=True)
+    doctor_code = sqlalchemy.Column(sqlalchemy.String(7), index=True)
     patient = orm.relation('Patient', back_populates='doctor',
                            passive_deletes='all')
     region_id = sqlalchemy.Column(sqlalchemy.Integer,
@@ -9,10 +9,14 @@ class Patient(SqlAlchemyBase):
     id = sqlalchemy.Column(sqlalchemy.Integer, autoincrement=True,
                            primary_key=True)
     name = sqlalchemy.Column(sqlalchemy.String(45))
+    # Уникальный индекс также используется для поиска по префиксу кода
+    # (LIKE 'code%'), поэтому шаблон не должен начинаться с %
     user_code = sqlalchemy.Column(sqlalchemy.String(20), unique=True)
     time_zone = sqlalchemy.Column(sqlalchemy.String(45))
     chat_id = sqlalchemy.Column(sqlalchemy.BIGINT, unique=True)
     member = sqlalchemy.Column(sqlalchemy.Boolean, default=True)
+    # Когда пациент исключен из исследования (для удаления по сроку)
+    excluded_at = sqlalchemy.Column(sqlalchemy.DateTime)
     accept_time = orm.relation('AcceptTime', back_populates='patient',
                                passive_deletes='all')
     doctor_id = sqlalchemy.Column(sqlalchemy.Integer,
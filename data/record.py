@@ -6,6 +6,11 @@ from .db_session import SqlAlchemyBase
 
 class Record(SqlAlchemyBase):
     __tablename__ = 'record'
+    # Поиск последнего ответа по времени приема
+    __table_args__ = (
+        sqlalchemy.Index('ix_record_accept_time_id_response_time',
+                         'accept_time_id', 'response_time'),
+    )
 
     id = sqlalchemy.Column(sqlalchemy.Integer, autoincrement=True,
                            primary_key=True)
@@ -1,19 +1,79 @@
 import csv
-import os
+import datetime as dt
+import io
+import tempfile
+from threading import Lock
 from typing import Any
 
+from cachetools import TTLCache
 from openpyxl import Workbook, styles
+from openpyxl.cell import WriteOnlyCell
+from sqlalchemy import DateTime, bindparam, case, func, insert, not_, or_
 
 from data import db_session
 from data.accept_time import AcceptTime
+from data.alarm import Alarm
 from data.patient import Patient
 from data.doctor import Doctor
 from data.record import Record
 from data.region import Region
 from data.university import University
+from tools.tools import get_from_env
 
 db_session.global_init()
 
+# Кэш времени последнего ответа по accept_time_id.
+# None - ответов еще не было. Обновляется в add_record.
+_last_response_cache = {}
+# Кэш наличия любых записей (в т.ч. пустых) по accept_time_id
+_has_records_cache = {}
+_last_response_lock = Lock()
+
+# Выгрузки читаются из бд частями и пишутся в буфер,
+# который переходит на диск после EXPORT_MEMORY_LIMIT байт
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_MEMORY_LIMIT = 1024 * 1024
+
+
+# Кэш справочников (регионы, врачи, университет) по коду, chat_id и id.
+# Заполняется при восстановлении и обновляется в add_region/add_doctor/...
+_directory_cache = TTLCache(
+    maxsize=int(get_from_env('DIRECTORY_CACHE_SIZE', '4096')),
+    ttl=int(get_from_env('DIRECTORY_CACHE_TTL', '3600')))
+_directory_lock = Lock()
+_directory_keys = {
+    'University': ('id', 'chat_id'),
+    'Region': ('id', 'chat_id', 'region_code'),
+    'Doctor': ('id', 'chat_id', 'doctor_code'),
+}
+
+
+def _cache_directory(*rows) -> None:
+    with _directory_lock:
+        for row in rows:
+            name = type(row).__name__
+            for attr in _directory_keys[name]:
+                _directory_cache[(name, attr, getattr(row, attr))] = row
+
+
+def _get_from_directory(model, attr: str, value):
+    """Поиск в справочнике через кэш. Отсутствующие строки не кэшируются"""
+    key = (model.__name__, attr, value)
+    with _directory_lock:
+        row = _directory_cache.get(key)
+    if row is None:
+        with db_session.create_session() as db_sess:
+            row = db_sess.query(model).filter(
+                getattr(model, attr) == value).first()
+        if row is not None:
+            _cache_directory(row)
+    return row
+
+
+def invalidate_directory_cache() -> None:
+    with _directory_lock:
+        _directory_cache.clear()
+
 
 def create_session():
     db_sess = db_session.create_session()
@@ -29,23 +89,22 @@ def add_university(**kwargs: Any) -> None:
         university = University(**kwargs)
         db_sess.add(university)
         db_sess.commit()
+    _cache_directory(university)
 
 
 def get_all_uni():
     with db_session.create_session() as db_sess:
-        return db_sess.query(University).all()
+        universities = db_sess.query(University).all()
+    _cache_directory(*universities)
+    return universities
 
 
 def get_university_by_chat_id(chat_id: int) -> University:
-    with db_session.create_session() as db_sess:
-        return db_sess.query(University).filter(
-            University.chat_id == chat_id).first()
+    return _get_from_directory(University, 'chat_id', chat_id)
 
 
 def get_university_by_id(id: int) -> University:
-    with db_session.create_session() as db_sess:
-        return db_sess.query(University).filter(
-            University.id == id).first()
+    return _get_from_directory(University, 'id', id)
 
 
 """Region functions"""
@@ -56,29 +115,26 @@ def add_region(**kwargs: Any) -> None:
         region = Region(**kwargs)
         db_sess.add(region)
         db_sess.commit()
+    _cache_directory(region)
 
 
 def get_all_regions():
     with db_session.create_session() as db_sess:
-        return db_sess.query(Region).all()
+        regions = db_sess.query(Region).all()
+    _cache_directory(*regions)
+    return regions
 
 
 def get_region_by_id(id: int) -> Region:
-    with db_session.create_session() as db_sess:
-        return db_sess.query(Region).filter(
-            Region.id == id).first()
+    return _get_from_directory(Region, 'id', id)
 
 
 def get_region_by_code(code: str) -> Region:
-    with db_session.create_session() as db_sess:
-        return db_sess.query(Region).filter(
-            Region.region_code == code).first()
+    return _get_from_directory(Region, 'region_code', code)
 
 
 def get_region_by_chat_id(chat_id: int) -> Region:
-    with db_session.create_session() as db_sess:
-        return db_sess.query(Region).filter(
-            Region.chat_id == chat_id).first()
+    return _get_from_directory(Region, 'chat_id', chat_id)
 
 
 """Doctor functions"""
@@ -89,11 +145,14 @@ def add_doctor(**kwargs: Any) -> None:
         doctor = Doctor(**kwargs)
         db_sess.add(doctor)
         db_sess.commit()
+    _cache_directory(doctor)
 
 
 def get_all_doctors():
     with db_session.create_session() as db_sess:
-        return db_sess.query(Doctor).all()
+        doctors = db_sess.query(Doctor).all()
+    _cache_directory(*doctors)
+    return doctors
 
 
 def get_all_doctors_by_user_code(code) -> list:
@@ -104,26 +163,66 @@ def get_all_doctors_by_user_code(code) -> list:
 
 
 def get_doctor_by_code(code: str) -> Doctor:
-    with db_session.create_session() as db_sess:
-        return db_sess.query(Doctor).filter(
-            Doctor.doctor_code == code).first()
+    return _get_from_directory(Doctor, 'doctor_code', code)
 
 
 def get_doctor_by_chat_id(chat_id: int) -> Doctor:
-    with db_session.create_session() as db_sess:
-        return db_sess.query(Doctor).filter(Doctor.chat_id == chat_id).first()
+    return _get_from_directory(Doctor, 'chat_id', chat_id)
 
 
 """Patient functions"""
 
 
-def add_patient(time_morn, time_even, **kwargs: Any):
-    with db_session.create_session() as db_sess:
-        patient = Patient(**kwargs)
-        db_sess.add(patient)
+def add_patient(time_morn, time_even, records=None, **kwargs: Any) -> dict:
+    """
+    Регистрация пациента: пациент, оба времени приема и начальные записи
+    сохраняются одной транзакцией
+    :param records: {'MOR' | 'EVE': {поля Record}} - начальные записи
+    :return: {'MOR': accept_time_id, 'EVE': accept_time_id}
+    """
+    return add_patients([dict(kwargs, time_morn=time_morn,
+                              time_even=time_even, records=records)])[0]
+
+
+def add_patients(patients: list) -> list:
+    """
+    Регистрация пачки пациентов одной транзакцией
+    :param patients: [{поля Patient, time_morn, time_even, records}, ...]
+    :return: [{'MOR': accept_time_id, 'EVE': accept_time_id}, ...]
+    """
+    added = []
+    with db_session.create_session() as db_sess:
+        for kwargs in patients:
+            kwargs = dict(kwargs)
+            times = {'MOR': kwargs.pop('time_morn'),
+                     'EVE': kwargs.pop('time_even')}
+            records = kwargs.pop('records', None) or {}
+            patient = Patient(**kwargs)
+            accept_times = {name: AcceptTime(time=time, patient=patient)
+                            for name, time in times.items()}
+            for name, fields in records.items():
+                accept_times[name].record_count = 1
+                accept_times[name].last_response_at = _response_time(fields)
+            db_sess.add(patient)
+            db_sess.add_all(accept_times.values())
+            db_sess.add_all(Record(accept_time=accept_times[name], **fields)
+                            for name, fields in records.items())
+            added.append((accept_times, records))
         db_sess.commit()
-    return {'MOR': add_accept_time(time_morn, patient),
-            'EVE': add_accept_time(time_even, patient)}
+
+    result = []
+    for accept_times, records in added:
+        ids = {name: accept_time.id
+               for name, accept_time in accept_times.items()}
+        # Записей у новых времен приема нет, кроме начальных
+        with _last_response_lock:
+            for accept_time_id in ids.values():
+                _last_response_cache.setdefault(accept_time_id, None)
+                _has_records_cache.setdefault(accept_time_id, False)
+        for name, fields in records.items():
+            cache_record(accept_time_id=ids[name], **fields)
+        result.append(ids)
+    return result
 
 
 def get_patient_by_chat_id(chat_id: int) -> Patient:
@@ -155,6 +254,31 @@ def get_all_patients() -> list:
         return db_sess.query(Patient).all()
 
 
+def get_restore_snapshot() -> list:
+    """
+    Данные для восстановления всех участвующих пациентов за 2 запроса.
+    Заодно заполняет кэш последних ответов.
+    :return: [(patient, [accept_time, ...]), ...]
+    """
+    with db_session.create_session() as db_sess:
+        patients = db_sess.query(Patient).filter(
+            Patient.member == True).order_by(Patient.id).all()
+        accept_times = db_sess.query(AcceptTime).join(Patient).filter(
+            Patient.member == True).order_by(AcceptTime.patient_id,
+                                             AcceptTime.id).all()
+
+    with _last_response_lock:
+        for accept_time in accept_times:
+            _last_response_cache[accept_time.id] = \
+                accept_time.last_response_at
+            _has_records_cache[accept_time.id] = accept_time.record_count > 0
+
+    by_patient = {}
+    for accept_time in accept_times:
+        by_patient.setdefault(accept_time.patient_id, []).append(accept_time)
+    return [(patient, by_patient.get(patient.id, [])) for patient in patients]
+
+
 def get_all_patients_v2():
     dct = {}
     with db_session.create_session() as db_sess:
@@ -168,23 +292,71 @@ def get_all_patients_v2():
         print(list(dct.items()))
 
 
-def del_patient(p_id):
+def del_patient(p_id) -> int:
+    """Удаление пациента одним запросом. Времена приема, записи и
+    оповещения удаляются бд каскадно (ondelete='CASCADE')"""
     with db_session.create_session() as db_sess:
-        patient = db_sess.query(Patient).filter_by(id=p_id).first()
-        for accept_time in patient.accept_time:
-            for record in accept_time.record:
-                db_sess.delete(record)
-            db_sess.delete(accept_time)
-        db_sess.delete(patient)
+        accept_time_ids = [accept_time_id for accept_time_id, in
+                           db_sess.query(AcceptTime.id).filter(
+                               AcceptTime.patient_id == p_id)]
+        count = db_sess.query(Patient).filter(Patient.id == p_id).delete(
+            synchronize_session=False)
         db_sess.commit()
-
-
-def change_patients_time_zone(chat_id: int, time_zone: int) -> None:
-    with db_session.create_session() as db_sess:
-        patient = get_patient_by_chat_id(chat_id)
-        patient.time_zone = time_zone
-        db_sess.add(patient)
+    forget_accept_times(accept_time_ids)
+    return count
+
+
+def purge_excluded_patients(before: dt.datetime, chunk_size=50,
+                            on_deleted=None) -> int:
+    """
+    Удаление пациентов, исключенных до before, у которых нет ответов
+    после before. Пациенты удаляются частями по chunk_size, каждая часть -
+    отдельная короткая транзакция, чтобы не блокировать таблицы надолго.
+    :param on_deleted: вызывается со списком chat_id после каждой части
+    :return: количество удаленных пациентов
+    """
+    total = 0
+    while True:
+        with db_session.create_session() as db_sess:
+            # Ответы ищем для каждого исключенного пациента отдельно:
+            # по индексам accept_time.patient_id и
+            # (record.accept_time_id, record.response_time)
+            answered = db_sess.query(Record.id).join(AcceptTime).filter(
+                AcceptTime.patient_id == Patient.id,
+                Record.response_time >= before).exists()
+            patients = db_sess.query(Patient.id, Patient.chat_id).filter(
+                Patient.member == False, Patient.excluded_at <= before,
+                ~answered).order_by(Patient.id).limit(chunk_size).all()
+            if not patients:
+                return total
+            patient_ids = [patient_id for patient_id, chat_id in patients]
+            accept_time_ids = [accept_time_id for accept_time_id, in
+                               db_sess.query(AcceptTime.id).filter(
+                                   AcceptTime.patient_id.in_(patient_ids))]
+            total += db_sess.query(Patient).filter(
+                Patient.id.in_(patient_ids)).delete(synchronize_session=False)
+            db_sess.commit()
+        forget_accept_times(accept_time_ids)
+        if on_deleted:
+            on_deleted([chat_id for patient_id, chat_id in patients])
+
+
+def _as_list(values) -> list:
+    """Одно значение или несколько"""
+    if isinstance(values, (str, int)):
+        return [values]
+    return list(values)
+
+
+def change_patients_time_zone(chat_ids, time_zone: str) -> int:
+    """Часовой пояс пациента (или списка пациентов) по chat_id.
+    Возвращает количество измененных пациентов"""
+    with db_session.create_session() as db_sess:
+        count = db_sess.query(Patient).filter(
+            Patient.chat_id.in_(_as_list(chat_ids))).update(
+            {Patient.time_zone: time_zone}, synchronize_session=False)
         db_sess.commit()
+    return count
 
 
 def patient_exists_by_user_code(patient_code):
@@ -208,96 +380,125 @@ def patient_exists_by_user_code(patient_code):
             Patient.user_code == patient_code).exists()).scalar()
 
 
-def change_patients_membership(user_code: str) -> None:
-    with db_session.create_session() as db_sess:
-        patient = get_patient_by_user_code(user_code)
-        patient.member = not patient.member
-        db_sess.add(patient)
+def change_patients_membership(user_codes, member: bool = None) -> int:
+    """
+    Участие пациента (или списка пациентов) в исследовании по коду.
+    При исключении запоминается его время (excluded_at)
+    :param member: новое значение, None - меняем на противоположное
+    :return: количество измененных пациентов
+    """
+    now = dt.datetime.utcnow()
+    if member is None:
+        # MySQL вычисляет SET слева направо по уже измененным значениям,
+        # поэтому excluded_at ставим первым - по старому значению member
+        values = [(Patient.excluded_at,
+                   case((Patient.member == True, now), else_=None)),
+                  (Patient.member, not_(Patient.member))]
+    elif member:
+        values = [(Patient.excluded_at, None), (Patient.member, True)]
+    else:
+        # Уже исключенным пациентам время исключения не меняем
+        values = [(Patient.excluded_at,
+                   case((Patient.member == True, now),
+                        else_=Patient.excluded_at)),
+                  (Patient.member, False)]
+    with db_session.create_session() as db_sess:
+        count = db_sess.query(Patient).filter(
+            Patient.user_code.in_(_as_list(user_codes))).update(
+            values, synchronize_session=False,
+            update_args={'preserve_parameter_order': True})
         db_sess.commit()
+    return count
+
+
+def exclude_patients(user_codes) -> int:
+    """Исключение пациентов из исследования по списку кодов"""
+    return change_patients_membership(user_codes, member=False)
+
+
+def _export_buffer():
+    """Буфер для выгрузки: в памяти, а при большом размере - на диске"""
+    return tempfile.SpooledTemporaryFile(max_size=EXPORT_MEMORY_LIMIT)
+
+
+def _records_by_user_code(db_sess, user_code, *columns):
+    """Потоковая выборка записей пациентов по префиксу кода"""
+    return db_sess.query(*columns).select_from(Patient).join(
+        AcceptTime, AcceptTime.patient_id == Patient.id).join(
+        Record, Record.accept_time_id == AcceptTime.id).filter(
+        Patient.user_code.like(f'{user_code}%')).yield_per(EXPORT_CHUNK_SIZE)
 
 
 def make_file_by_patient_user_code(patient_code):
-    if not os.path.isdir("static"):
-        os.mkdir("static")
-    response = f"""SELECT record.sys_press,
-                   record.dias_press, record.heart_rate, record.time,
-                   record.time_zone, record.response_time, record.comment FROM
-                   patient JOIN accept_time on patient.id = 
-                   accept_time.Patient_id JOIN record on accept_time.id = 
-                   record.accept_time_id WHERE patient.user_code like 
-                   '{patient_code}%'"""
-    with db_session.create_session() as db_sess:
-        records = db_sess.execute(response)
+    """Выгрузка записей пациента в xlsx. Возвращает файловый объект"""
     headers = ['Систолическое давление', 'Диастолическое давление',
                'Частота сердечных сокращений',
                'Время приема таблеток и измерений', 'Часовой пояс',
                'Время ответа', 'Комментарий']
-    wb = Workbook()
-    ws = wb.active
-    for i in range(len(headers)):
-        ws.cell(row=1, column=i + 1, value=headers[i])
-    i = 2
-    for record in records:
-        for j in range(7):
-            ws.cell(row=i, column=j + 1, value=record[j])
-        i += 1
-    wb.save(filename=os.path.join(
-        os.path.abspath(os.curdir),
-        os.path.join('static', f'{patient_code}_data.xlsx')))
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(headers)
+    with db_session.create_session() as db_sess:
+        for record in _records_by_user_code(
+                db_sess, patient_code, Record.sys_press, Record.dias_press,
+                Record.heart_rate, Record.time, Record.time_zone,
+                Record.response_time, Record.comment):
+            ws.append(list(record))
+    buffer = _export_buffer()
+    wb.save(buffer)
+    buffer.seek(0)
+    return buffer
 
 
 def make_file_patients(user_code=''):
-    if not os.path.isdir("static"):
-        os.mkdir("static")
-    response = f"""SELECT patient.id, patient.user_code,
-                   record.sys_press, record.dias_press,
-                   record.heart_rate, record.time, record.time_zone,
-                   record.response_time, record.comment FROM patient
-                   JOIN accept_time on patient.id =
-                   accept_time.Patient_id JOIN record on accept_time.id
-                   = record.accept_time_id WHERE patient.user_code LIKE
-                    '{user_code}%'"""
-    with db_session.create_session() as db_sess:
-        records = db_sess.execute(response)
-    # wb = Workbook()
-    # ws = wb.active
+    """Выгрузка записей всех пациентов в csv. Возвращает файловый объект"""
     headers = ['ID пациента', 'Код пациента', 'Систолическое давление',
                'Диастолическое давление', 'Частота сердечных сокращений',
                'Время приема таблеток и измерений', 'Часовой пояс',
                'Время ответа', 'Комментарий']
-    with open(os.path.join('static', f'statistics.csv'), 'w',
-              encoding='utf-8', newline='') as csvfile:
-        writer = csv.writer(csvfile, delimiter=';', quotechar='"',
-                            quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(headers)
-        for record in records:
-            writer.writerow(record)
-    # for i in range(len(headers)):
-    #     ws.cell(row=1, column=i + 1, value=headers[i])
-    # i = 2
-    # for record in records:
-    #     for j in range(9):
-    #         ws.cell(row=i, column=j+1, value=record[j])
-    #     i += 1
-    # wb.save(filename='static/statistics.xlsx')
+    buffer = _export_buffer()
+    # SpooledTemporaryFile в python 3.9 нельзя обернуть в TextIOWrapper,
+    # поэтому строка пишется в StringIO и в буфер попадает уже в байтах
+    line = io.StringIO(newline='')
+    writer = csv.writer(line, delimiter=';', quotechar='"',
+                        quoting=csv.QUOTE_MINIMAL)
+
+    def write_row(row):
+        writer.writerow(row)
+        buffer.write(line.getvalue().encode('utf-8'))
+        line.seek(0)
+        line.truncate()
+
+    write_row(headers)
+    with db_session.create_session() as db_sess:
+        for record in _records_by_user_code(
+                db_sess, user_code, Patient.id, Patient.user_code,
+                Record.sys_press, Record.dias_press, Record.heart_rate,
+                Record.time, Record.time_zone, Record.response_time,
+                Record.comment):
+            write_row(record)
+    buffer.seek(0)
+    return buffer
 
 
 def make_patient_list(user_code=''):
-    if not os.path.isdir("static"):
-        os.mkdir("static")
-    with db_session.create_session() as db_sess:
-        patients_user_codes = db_sess.query(
-            Patient.user_code, Patient.member) \
-            .filter(Patient.user_code.like(f"{user_code}%")).all()
-    wb = Workbook()
-    ws = wb.active
-    for i in range(len(patients_user_codes)):
-        cell = ws.cell(row=i + 1, column=1, value=patients_user_codes[i][0])
-        if not patients_user_codes[i][1]:
-            cell.fill = styles.PatternFill('solid', fgColor='FF0000')
-    wb.save(filename=os.path.join(
-        os.path.abspath(os.curdir),
-        os.path.join('static', f'Список пациентов.xlsx')))
+    """Список кодов пациентов в xlsx. Возвращает файловый объект"""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    excluded = styles.PatternFill('solid', fgColor='FF0000')
+    with db_session.create_session() as db_sess:
+        for code, member in db_sess.query(
+                Patient.user_code, Patient.member).filter(
+                Patient.user_code.like(f"{user_code}%")).yield_per(
+                EXPORT_CHUNK_SIZE):
+            cell = WriteOnlyCell(ws, value=code)
+            if not member:
+                cell.fill = excluded
+            ws.append([cell])
+    buffer = _export_buffer()
+    wb.save(buffer)
+    buffer.seek(0)
+    return buffer
 
 
 """Accept time functions"""
@@ -313,17 +514,40 @@ def add_accept_time(time, patient: Patient) -> int:
 
 def get_accept_times_by_patient_id(p_id: int):
     with db_session.create_session() as db_sess:
-        return db_sess.query(AcceptTime).filter(AcceptTime.patient_id ==
-                                                p_id).all()
+        return db_sess.query(AcceptTime).filter(
+            AcceptTime.patient_id == p_id).order_by(AcceptTime.id).all()
 
 
-def change_accept_time(accept_time_id, time):
+def change_accept_time(accept_time_ids, time) -> int:
+    """Время приема (одно или список) по id.
+    Возвращает количество измененных времен приема"""
     with db_session.create_session() as db_sess:
-        accept_time = db_sess.query(AcceptTime).filter(AcceptTime.id ==
-                                                       accept_time_id).first()
-        accept_time.time = time
-        db_sess.add(accept_time)
+        count = db_sess.query(AcceptTime).filter(
+            AcceptTime.id.in_(_as_list(accept_time_ids))).update(
+            {AcceptTime.time: time}, synchronize_session=False)
+        db_sess.commit()
+    return count
+
+
+def shift_accept_times(user_code: str, delta: dt.timedelta) -> int:
+    """
+    Сдвиг времени приема всех пациентов, чей код начинается с user_code
+    (регион, врач), на delta. Время сдвигается в пределах суток.
+    Возвращает количество измененных времен приема
+    """
+    with db_session.create_session() as db_sess:
+        # Арифметика со временем в sqlite и MySQL разная, поэтому новое
+        # время считаем здесь, а сохраняем одним пакетом UPDATE по id
+        rows = db_sess.query(AcceptTime.id, AcceptTime.time).join(
+            Patient).filter(Patient.user_code.like(f'{user_code}%')).all()
+        today = dt.date.today()
+        changes = [
+            {'id': accept_time_id,
+             'time': (dt.datetime.combine(today, time) + delta).time()}
+            for accept_time_id, time in rows if time is not None]
+        db_sess.bulk_update_mappings(AcceptTime, changes)
         db_sess.commit()
+    return len(changes)
 
 
 """Record functions"""
@@ -333,22 +557,172 @@ def add_record(**kwargs: Any) -> None:
     with db_session.create_session() as db_sess:
         record = Record(**kwargs)
         db_sess.add(record)
+        _update_accept_time_stats(db_sess, [kwargs])
+        db_sess.commit()
+    cache_record(**kwargs)
+
+
+def _response_time(record: dict):
+    """Время ответа записи с данными давления (без часового пояса,
+    как в бд) или None"""
+    if record.get('sys_press') is None or not record.get('response_time'):
+        return None
+    return record['response_time'].replace(tzinfo=None)
+
+
+def _update_accept_time_stats(db_sess, records) -> None:
+    """Обновление AcceptTime.record_count и last_response_at
+    в транзакции добавления записей"""
+    stats = {}  # {accept_time_id: [количество, последний ответ]}
+    for record in records:
+        count_last = stats.setdefault(record['accept_time_id'], [0, None])
+        count_last[0] += 1
+        response_time = _response_time(record)
+        if response_time and (count_last[1] is None or
+                              count_last[1] < response_time):
+            count_last[1] = response_time
+
+    table = AcceptTime.__table__
+    by_id = table.c.id == bindparam('accept_time_id')
+    added = table.c.record_count + bindparam('added')
+    last = bindparam('last', type_=DateTime)
+    with_response = [{'accept_time_id': accept_time_id, 'added': count,
+                      'last': response_time}
+                     for accept_time_id, (count, response_time)
+                     in stats.items() if response_time]
+    without_response = [{'accept_time_id': accept_time_id, 'added': count}
+                        for accept_time_id, (count, response_time)
+                        in stats.items() if not response_time]
+    if with_response:
+        db_sess.execute(table.update().where(by_id).values(
+            record_count=added,
+            last_response_at=case(
+                (or_(table.c.last_response_at == None,
+                     table.c.last_response_at < last), last),
+                else_=table.c.last_response_at)), with_response)
+    if without_response:
+        db_sess.execute(table.update().where(by_id).values(
+            record_count=added), without_response)
+
+
+def backfill_accept_time_stats() -> int:
+    """Пересчет AcceptTime.record_count и last_response_at по записям
+    (для данных, добавленных до появления колонок)"""
+    by_accept_time = Record.accept_time_id == AcceptTime.id
+    with db_session.create_session() as db_sess:
+        count = db_sess.query(AcceptTime).update({
+            AcceptTime.last_response_at: db_sess.query(
+                func.max(Record.response_time)).filter(
+                by_accept_time, Record.sys_press != None).scalar_subquery(),
+            AcceptTime.record_count: db_sess.query(
+                func.count(Record.id)).filter(
+                by_accept_time).scalar_subquery(),
+        }, synchronize_session=False)
+        db_sess.commit()
+    with _last_response_lock:
+        _last_response_cache.clear()
+        _has_records_cache.clear()
+    return count
+
+
+def cache_record(**kwargs: Any) -> None:
+    """Обновление кэша последнего ответа после добавления записи"""
+    with _last_response_lock:
+        _has_records_cache[kwargs['accept_time_id']] = True
+    response_time = _response_time(kwargs)
+    if response_time is None:
+        return None
+    with _last_response_lock:
+        last = _last_response_cache.get(kwargs['accept_time_id'])
+        if last is None or last <= response_time:
+            _last_response_cache[kwargs['accept_time_id']] = response_time
+
+
+def forget_accept_times(accept_time_ids) -> None:
+    """Удаление записей кэша (например, после удаления пациента)"""
+    with _last_response_lock:
+        for accept_time_id in accept_time_ids:
+            _last_response_cache.pop(accept_time_id, None)
+            _has_records_cache.pop(accept_time_id, None)
+
+
+def write_batch(records=(), accept_times=None, time_zones=None,
+                alarms=()) -> None:
+    """
+    Сохранение пачки изменений одной транзакцией
+    :param records: [{поля Record}, ...]
+    :param accept_times: {accept_time_id: time}
+    :param time_zones: {chat_id: time_zone}
+    :param alarms: [{поля Alarm}, ...]
+    """
+    with db_session.create_session() as db_sess:
+        if records:
+            db_sess.bulk_insert_mappings(Record, records)
+            _update_accept_time_stats(db_sess, records)
+        if alarms:
+            # Оповещение уже могло быть записано до перезапуска
+            db_sess.execute(insert(Alarm).prefix_with(
+                'OR IGNORE', dialect='sqlite').prefix_with(
+                'IGNORE', dialect='mysql'), list(alarms))
+        if accept_times:
+            db_sess.bulk_update_mappings(
+                AcceptTime, [{'id': accept_time_id, 'time': time}
+                             for accept_time_id, time in accept_times.items()])
+        if time_zones:
+            by_tz = {}
+            for chat_id, time_zone in time_zones.items():
+                by_tz.setdefault(time_zone, []).append(chat_id)
+            for time_zone, chat_ids in by_tz.items():
+                db_sess.query(Patient).filter(
+                    Patient.chat_id.in_(chat_ids)).update(
+                    {Patient.time_zone: time_zone}, synchronize_session=False)
         db_sess.commit()
 
 
-def get_last_record_by_accept_time(accept_time_id):
+def get_last_record_by_accept_time(accept_time_id) -> Record:
+    """Последний ответ (запись с данными давления) по времени приема"""
     with db_session.create_session() as db_sess:
-        # max_time = db_sess.query(func.max(Record.response_time)).filter(
-        #     Record.accept_time_id == accept_time_id and
-        #     Record.sys_press.isnot(None))
-        # record = db_sess.query(Record).filter(
-        #     Record.response_time == max_time and
-        #     Record.accept_time_id == accept_time_id).first()
-        # return record
-        records = db_sess.query(Record).filter(
+        return db_sess.query(Record).filter(
             Record.accept_time_id == accept_time_id,
-            Record.sys_press != None).all()
-        return records
+            Record.sys_press != None).order_by(
+            Record.response_time.desc(), Record.id.desc()).first()
+
+
+def _get_accept_time_stats(accept_time_id):
+    """(record_count, last_response_at) времени приема по первичному ключу"""
+    with db_session.create_session() as db_sess:
+        return db_sess.query(AcceptTime.record_count,
+                             AcceptTime.last_response_at).filter(
+            AcceptTime.id == accept_time_id).first() or (0, None)
+
+
+def get_last_response_time(accept_time_id):
+    """Время последнего ответа по времени приема.
+    Обращается к бд только если значения нет в кэше"""
+    with _last_response_lock:
+        if accept_time_id in _last_response_cache:
+            return _last_response_cache[accept_time_id]
+    response_time = _get_accept_time_stats(accept_time_id)[1]
+    with _last_response_lock:
+        # Пока шел запрос могла добавиться более новая запись
+        last = _last_response_cache.get(accept_time_id)
+        if last is None or (response_time and last < response_time):
+            _last_response_cache[accept_time_id] = response_time
+        return _last_response_cache[accept_time_id]
+
+
+def has_records(accept_time_id) -> bool:
+    """Есть ли у времени приема хотя бы одна запись"""
+    with _last_response_lock:
+        if _has_records_cache.get(accept_time_id):
+            return True
+        if accept_time_id in _has_records_cache:
+            return False
+    exists = _get_accept_time_stats(accept_time_id)[0] > 0
+    with _last_response_lock:
+        exists = _has_records_cache.get(accept_time_id) or exists
+        _has_records_cache[accept_time_id] = exists
+        return exists
 
 
 def get_all_records_by_accept_time(accept_time_id):
@@ -356,3 +730,44 @@ def get_all_records_by_accept_time(accept_time_id):
         records = db_sess.query(Record).filter(
             Record.accept_time_id == accept_time_id).all()
         return records
+
+
+"""Alarm functions"""
+
+
+def purge_alarms(before: dt.date, chunk_size=1000) -> int:
+    """Удаление записей об оповещениях до дня before частями по chunk_size"""
+    total = 0
+    while True:
+        with db_session.create_session() as db_sess:
+            alarm_ids = [alarm_id for alarm_id, in db_sess.query(
+                Alarm.id).filter(Alarm.day < before).order_by(
+                Alarm.id).limit(chunk_size)]
+            if not alarm_ids:
+                return total
+            total += db_sess.query(Alarm).filter(
+                Alarm.id.in_(alarm_ids)).delete(synchronize_session=False)
+            db_sess.commit()
+
+
+def get_overdue_patients(before: dt.datetime) -> list:
+    """
+    Времена приема участвующих пациентов, последний ответ на которые был
+    не позже before (пациенты без ответов не учитываются).
+    Строки одного пациента идут подряд, утреннее время приема - первым
+    :return: [(chat_id, user_code, time_zone, last_response_at), ...]
+    """
+    with db_session.create_session() as db_sess:
+        return db_sess.query(
+            Patient.chat_id, Patient.user_code, Patient.time_zone,
+            AcceptTime.last_response_at).join(AcceptTime).filter(
+            Patient.member == True,
+            AcceptTime.last_response_at <= before).order_by(
+            Patient.id, AcceptTime.id).all()
+
+
+def get_alarms_since(day) -> list:
+    """Оповещения, отправленные начиная с day: [(chat_id, kind, day), ...]"""
+    with db_session.create_session() as db_sess:
+        return db_sess.query(Alarm.chat_id, Alarm.kind, Alarm.day).filter(
+            Alarm.day >= day).all()
@@ -1,21 +1,38 @@
 import logging
 import os
 import atexit
-from tools.atexit import clear_all_notification
+from queue import Queue
+from tools.atexit import (clear_all_notification, flush_db_writer,
+                          stop_background, stop_send_queue)
 
 from telegram import Update, error
-from telegram.ext import (CommandHandler, Defaults,
-                          Filters, MessageHandler, Updater, CallbackContext)
-
+from telegram.ext import (CommandHandler, Defaults, Dispatcher, ExtBot,
+                          Filters, JobQueue, MessageHandler, TypeHandler,
+                          Updater, CallbackContext)
+from telegram.utils.request import Request
+
+from modules.alarm_ledger import alarm_ledger
+from modules.alarm_sweep import start_alarm_sweep
+from modules.db_writer import db_writer
+from modules.executor import background
 from modules.notification_dailogs import DataCollectionDialog, PillTakingDialog
 from modules.patronage_dialogs import BaseJob
+from modules.persistence import create_persistence, detach_job_queue
 from modules.restore import Restore
+from modules.retention import start_retention
+from modules.send_queue import send_queue
 from modules.settings_dialogs import SettingsDialog
 from modules.start_dialogs import StartDialog
+from modules.timer import resume_scheduler, scheduler_stats, start_scheduler
 from modules.users_list import users_list
 
+from data.db_session import pool_status
 from tools.tools import get_from_env
 
+# polling - бот сам запрашивает обновления (long polling),
+# webhook - Telegram отправляет обновления на встроенный сервер (tornado)
+UPDATE_MODE = get_from_env('UPDATE_MODE', 'polling').lower()
+
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(name)s %(message)s')
 
@@ -58,23 +75,108 @@ def help_msg(update: Update, context: CallbackContext):
         pass
 
 
+def log_stats(context: CallbackContext):
+    """Периодическая статистика пула соединений с бд и очереди записи"""
+    logging.info(f'DB POOL: {pool_status()}')
+    logging.info(f'DB WRITER QUEUE: {db_writer.qsize()}')
+    logging.info(f'SCHEDULER: {scheduler_stats(context)}')
+    logging.info(f'SEND QUEUE: {send_queue.stats()}')
+    logging.info(f'USERS LIST: {users_list.stats()}')
+    logging.info(f'BACKGROUND: {background.stats()}')
+    logging.info(f'ALARMS: {alarm_ledger.stats()}')
+    logging.info(f'UPDATE QUEUE: {context.dispatcher.update_queue.qsize()}')
+    if context.dispatcher.persistence:
+        logging.info(f'PERSISTENCE: {context.dispatcher.persistence.stats()}')
+
+
+def touch_user(update: Update, context: CallbackContext):
+    """Отмечаем активность пользователя, чтобы его не выгрузили из памяти
+    посреди диалога (USERS_LIST_MODE=lazy)"""
+    if update.effective_user:
+        users_list.touch(update.effective_user.id)
+
+
+def start_webhook(updater: Updater):
+    """
+    Получение обновлений через вебхук.
+    Если сертификат и ключ не указаны, сервер принимает http, а TLS
+    завершается на прокси (nginx и т.п.), который передает запросы
+    на WEBHOOK_LISTEN:WEBHOOK_PORT.
+    """
+    cert = get_from_env('WEBHOOK_CERT', '') or None
+    key = get_from_env('WEBHOOK_KEY', '') or None
+    url_path = get_from_env('WEBHOOK_URL_PATH', 'webhook').strip('/')
+    webhook_url = get_from_env('WEBHOOK_URL')
+    if not webhook_url.endswith(url_path):
+        webhook_url = f"{webhook_url.rstrip('/')}/{url_path}"
+
+    updater.start_webhook(
+        listen=get_from_env('WEBHOOK_LISTEN', '0.0.0.0'),
+        port=int(get_from_env('WEBHOOK_PORT', '8443')),
+        url_path=url_path,
+        cert=cert,
+        key=key,
+        webhook_url=webhook_url,
+        max_connections=int(get_from_env('WEBHOOK_MAX_CONNECTIONS', '40')),
+        drop_pending_updates=get_from_env(
+            'WEBHOOK_DROP_PENDING', 'false').lower() == 'true',
+    )
+    logging.info(f'WEBHOOK STARTED: {webhook_url}')
+
+
 def main():
     if not os.path.isdir("static"):
         os.mkdir("static")
 
-    updater = Updater(get_from_env('TOKEN'),
-                      workers=8, use_context=True,
-                      defaults=Defaults(run_async=True),
-                      request_kwargs={'read_timeout': 20,
-                                      'connect_timeout': 20})
-
-    dp = updater.dispatcher
-
+    workers = int(get_from_env('WORKERS', '8'))
+    # Соединения: потоки обработчиков, диспетчер, получение обновлений,
+    # JobQueue и основной поток
+    bot = ExtBot(get_from_env('TOKEN'),
+                 defaults=Defaults(run_async=True),
+                 request=Request(con_pool_size=workers + 4,
+                                 read_timeout=20, connect_timeout=20))
+    # Очередь входящих обновлений ограничена по памяти. Когда она полна,
+    # поток получения обновлений (или весь сервер вебхука: PTB кладет
+    # обновление в очередь блокирующим put в цикле tornado) ждет, пока
+    # обработчики освободят место. Обновления при этом не отклоняются,
+    # а Telegram повторяет только запросы, на которые не дождался ответа
+    update_queue = Queue(maxsize=int(get_from_env('UPDATE_QUEUE_SIZE', '0')))
+    job_queue = JobQueue()
+    # Состояния диалогов и user_data между перезапусками (PERSISTENCE)
+    persistence = create_persistence()
+    dp = Dispatcher(bot, update_queue, workers=workers, job_queue=job_queue,
+                    persistence=persistence, use_context=True)
+    job_queue.set_dispatcher(dp)
+    if persistence:
+        detach_job_queue(job_queue)
+    updater = Updater(dispatcher=dp, workers=None)
+
+    # При завершении бота отправляем запросы из очереди к Telegram API
+    atexit.register(stop_send_queue)
+    # При завершении бота сохраняем ответы, которые еще не записаны в бд
+    atexit.register(flush_db_writer)
+    # Фоновые задачи завершаются раньше очереди записи, т.к. пишут в нее
+    atexit.register(stop_background)
     # При заверении бота удаляем все сообщения с уведомлениями из чатов
     atexit.register(clear_all_notification, CallbackContext(dp))
 
+    # Минутный планировщик (если включен SCHEDULER_MODE=buckets)
+    start_scheduler(dp)
+
     # Восстановление уведомлений после перезапуска бота
     Restore(dp)
+    # Пропущенные задачи из хранилища выполняются после восстановления
+    resume_scheduler(dp)
+
+    dp.job_queue.run_repeating(log_stats, interval=600, first=600,
+                               name='log_stats')
+    # Оповещения врачам и регионам о пациентах без ответа
+    start_alarm_sweep(dp)
+    # Удаление исключенных пациентов и старых оповещений (RETENTION_MONTHS)
+    start_retention(dp)
+
+    dp.add_handler(TypeHandler(Update, touch_user, run_async=False),
+                   group=-1)
 
     dp.add_handler(StartDialog())
 
@@ -90,7 +192,10 @@ def main():
 
     dp.add_handler(MessageHandler(Filters.command, unknown))
 
-    updater.start_polling()
+    if UPDATE_MODE == 'webhook':
+        start_webhook(updater)
+    else:
+        updater.start_polling()
 
     # Ждём завершения приложения.
     updater.idle()
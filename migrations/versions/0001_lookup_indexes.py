@@ -0,0 +1,45 @@
+"""Индексы для колонок, по которым ищет db_api
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# (имя индекса, таблица, колонки)
+INDEXES = [
+    ('ix_doctor_doctor_code', 'doctor', ['doctor_code']),
+    ('ix_doctor_chat_id', 'doctor', ['chat_id']),
+    ('ix_region_region_code', 'region', ['region_code']),
+    ('ix_region_chat_id', 'region', ['chat_id']),
+    ('ix_university_chat_id', 'university', ['chat_id']),
+    ('ix_accept_time_patient_id', 'accept_time', ['patient_id']),
+    ('ix_record_accept_time_id_response_time', 'record',
+     ['accept_time_id', 'response_time']),
+]
+
+
+def _existing_indexes(table):
+    return {index['name'] for index in
+            sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def upgrade():
+    # Таблицы могли быть созданы через create_all() уже с индексами
+    for name, table, columns in INDEXES:
+        if name not in _existing_indexes(table):
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        if name in _existing_indexes(table):
+            op.drop_index(name, table_name=table)
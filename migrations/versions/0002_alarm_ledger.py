@@ -0,0 +1,40 @@
+"""Журнал отправленных оповещений врачам и регионам
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Таблица могла быть создана через create_all()
+    if sa.inspect(op.get_bind()).has_table('alarm'):
+        return None
+    op.create_table(
+        'alarm',
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('chat_id', sa.BIGINT,
+                  sa.ForeignKey('patient.chat_id', ondelete='CASCADE')),
+        sa.Column('kind', sa.String(10)),
+        sa.Column('day', sa.Date),
+        sa.Column('days', sa.Integer),
+        sa.Column('sent_at', sa.DateTime),
+        sa.UniqueConstraint('chat_id', 'kind', 'day',
+                            name='uq_alarm_chat_id_kind_day'),
+    )
+    op.create_index('ix_alarm_day', 'alarm', ['day'])
+
+
+def downgrade():
+    if sa.inspect(op.get_bind()).has_table('alarm'):
+        op.drop_index('ix_alarm_day', table_name='alarm')
+        op.drop_table('alarm')
@@ -0,0 +1,58 @@
+"""Время последнего ответа и количество записей в accept_time
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def _existing_columns():
+    return {column['name'] for column in
+            sa.inspect(op.get_bind()).get_columns('accept_time')}
+
+
+def backfill():
+    """Заполнение колонок по таблице record"""
+    accept_time = sa.table('accept_time', sa.column('id'),
+                           sa.column('last_response_at'),
+                           sa.column('record_count'))
+    record = sa.table('record', sa.column('accept_time_id'),
+                      sa.column('sys_press'), sa.column('response_time'))
+    by_accept_time = record.c.accept_time_id == accept_time.c.id
+    op.execute(accept_time.update().values(
+        last_response_at=sa.select(
+            sa.func.max(record.c.response_time)).where(
+            by_accept_time, record.c.sys_press != None).scalar_subquery(),
+        record_count=sa.select(sa.func.count()).select_from(record).where(
+            by_accept_time).scalar_subquery(),
+    ))
+
+
+def upgrade():
+    # Колонки могли быть созданы через create_all()
+    columns = _existing_columns()
+    with op.batch_alter_table('accept_time') as batch_op:
+        if 'last_response_at' not in columns:
+            batch_op.add_column(sa.Column('last_response_at', sa.DateTime))
+        if 'record_count' not in columns:
+            batch_op.add_column(sa.Column('record_count', sa.Integer,
+                                          nullable=False,
+                                          server_default='0'))
+    backfill()
+
+
+def downgrade():
+    columns = _existing_columns()
+    with op.batch_alter_table('accept_time') as batch_op:
+        for name in ('record_count', 'last_response_at'):
+            if name in columns:
+                batch_op.drop_column(name)
@@ -0,0 +1,42 @@
+"""Время исключения пациента из исследования
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+
+"""
+import datetime as dt
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def _existing_columns():
+    return {column['name'] for column in
+            sa.inspect(op.get_bind()).get_columns('patient')}
+
+
+def upgrade():
+    # Колонка могла быть создана через create_all()
+    if 'excluded_at' not in _existing_columns():
+        with op.batch_alter_table('patient') as batch_op:
+            batch_op.add_column(sa.Column('excluded_at', sa.DateTime))
+    # Время исключения уже исключенных пациентов неизвестно - считаем
+    # от миграции, чтобы они не удалились при первой же очистке
+    patient = sa.table('patient', sa.column('member'),
+                       sa.column('excluded_at'))
+    op.execute(patient.update().where(
+        patient.c.member == False, patient.c.excluded_at == None).values(
+        excluded_at=dt.datetime.utcnow()))
+
+
+def downgrade():
+    if 'excluded_at' in _existing_columns():
+        with op.batch_alter_table('patient') as batch_op:
+            batch_op.drop_column('excluded_at')
@@ -0,0 +1,64 @@
+import datetime as dt
+import logging
+import threading
+
+from db_api import get_alarms_since
+from modules.db_writer import db_writer
+from tools.tools import get_from_env
+
+DOCTOR_ALARM = 'doctor'
+REGION_ALARM = 'region'
+
+
+class AlarmLedger:
+    """
+    Журнал отправленных оповещений врачам и регионам.
+    Оповещение о пациенте отправляется не больше одного раза в день для
+    каждого типа. Отправленные за последние keep_days дней оповещения
+    загружаются из бд одним запросом при первой проверке, а новые
+    записываются в бд пачками через db_writer. Поэтому после перезапуска
+    бота оповещения за текущий день повторно не отправляются.
+    """
+
+    def __init__(self, keep_days=2):
+        self.keep_days = keep_days
+        self._lock = threading.Lock()
+        self._sent = None  # {(chat_id, тип, день)}
+        self._since = None  # самый ранний день в _sent
+        self.skipped = 0
+
+    def _load(self):
+        self._since = dt.date.today() - dt.timedelta(days=self.keep_days)
+        self._sent = {tuple(row) for row in get_alarms_since(self._since)}
+        logging.info(f'--- {len(self._sent)} ALARMS LOADED ---')
+
+    def _prune(self, day: dt.date):
+        since = day - dt.timedelta(days=self.keep_days)
+        if since > self._since:
+            self._sent = {key for key in self._sent if key[2] >= since}
+            self._since = since
+
+    def claim(self, chat_id, kind: str, day: dt.date, days: int) -> bool:
+        """Отмечаем оповещение как отправленное.
+        Возвращаем False, если сегодня оно уже было отправлено"""
+        key = (chat_id, kind, day)
+        with self._lock:
+            if self._sent is None:
+                self._load()
+            if key in self._sent:
+                self.skipped += 1
+                return False
+            self._prune(day)
+            self._sent.add(key)
+        db_writer.add_alarm(chat_id=chat_id, kind=kind, day=day, days=days,
+                            sent_at=dt.datetime.utcnow())
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'sent': len(self._sent or ()), 'skipped': self.skipped}
+
+
+alarm_ledger = AlarmLedger(
+    keep_days=int(get_from_env('ALARM_LEDGER_DAYS', '2'))
+)
@@ -0,0 +1,66 @@
+import datetime as dt
+import logging
+import time
+
+import pytz
+from telegram.ext import CallbackContext, Dispatcher
+
+from db_api import get_overdue_patients
+from modules.users_classes import DoctorUser, RegionUser
+from tools.tools import get_from_env
+
+# Через сколько часов без ответа оповещаем врача
+OVERDUE_HOURS = 25
+# Как часто ищем пациентов без ответа (сек.)
+ALARM_SWEEP_INTERVAL = int(get_from_env('ALARM_SWEEP_INTERVAL', '900'))
+# Самый большой часовой пояс (UTC+14)
+MAX_UTC_OFFSET = dt.timedelta(hours=14)
+
+
+def start_alarm_sweep(dispatcher: Dispatcher):
+    dispatcher.job_queue.run_repeating(sweep_overdue_patients,
+                                       interval=ALARM_SWEEP_INTERVAL,
+                                       first=10, name='alarm_sweep')
+
+
+def find_overdue_patients() -> list:
+    """
+    Пациенты без ответа на утреннее или вечернее уведомление
+    OVERDUE_HOURS часов и больше.
+    Время ответа хранится в бд по часовому поясу пациента, поэтому в бд
+    отбираем с запасом на любой часовой пояс, а точно проверяем каждое
+    время приема здесь. Дни без ответа считаем по первому просроченному
+    времени приема (утреннему, если просрочены оба)
+    :return: [{'chat_id', 'code', 'days', 'day'}, ...]
+    """
+    utc_now = dt.datetime.utcnow()
+    overdue = {}
+    for chat_id, code, tz_str, last_response in get_overdue_patients(
+            utc_now + MAX_UTC_OFFSET - dt.timedelta(hours=OVERDUE_HOURS)):
+        if chat_id in overdue:
+            continue
+        try:
+            now = dt.datetime.now(pytz.timezone(tz_str))
+        except (pytz.UnknownTimeZoneError, AttributeError):
+            logging.warning(f'PATIENT {chat_id} HAS WRONG TIME ZONE: '
+                            f'{tz_str}')
+            continue
+        hours = (now.replace(tzinfo=None) - last_response).total_seconds() \
+            // 3600
+        if hours >= OVERDUE_HOURS:
+            overdue[chat_id] = {'chat_id': chat_id, 'code': code,
+                                'days': int(hours // 24), 'day': now.date()}
+    return list(overdue.values())
+
+
+def sweep_overdue_patients(context: CallbackContext):
+    """Оповещения врачам (ежедневно) и регионам (раз в неделю)
+    о пациентах без ответа"""
+    start = time.perf_counter()
+    overdue = find_overdue_patients()
+    doctors = DoctorUser.send_alarms(context, overdue)
+    regions = RegionUser.send_alarms(
+        context, [alarm for alarm in overdue if not alarm['days'] % 7])
+    logging.info(f'--- ALARM SWEEP: {len(overdue)} OVERDUE, {doctors} TO '
+                 f'DOCTORS, {regions} TO REGIONS --- '
+                 f'{time.perf_counter() - start:.2f}s')
@@ -0,0 +1,143 @@
+import logging
+import queue
+import threading
+import time
+
+from db_api import cache_record, write_batch
+from tools.tools import get_from_env
+
+
+class DBWriter:
+    """
+    Отложенная запись в бд. Ответы пациентов и изменения настроек
+    складываются в ограниченную очередь, а один фоновый поток сохраняет
+    их пачками по размеру или по времени.
+    """
+    _STOP = object()
+
+    def __init__(self, batch_size=200, flush_interval=1.0, max_size=10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def add_record(self, **kwargs) -> None:
+        # Кэш обновляем сразу, чтобы проверки ответов не ждали записи в бд
+        cache_record(**kwargs)
+        self._put(('record', kwargs))
+
+    def change_accept_time(self, accept_time_id, time) -> None:
+        self._put(('accept_time', (accept_time_id, time)))
+
+    def change_time_zone(self, chat_id, time_zone) -> None:
+        self._put(('time_zone', (chat_id, time_zone)))
+
+    def add_alarm(self, **kwargs) -> None:
+        self._put(('alarm', kwargs))
+
+    def qsize(self) -> int:
+        """Глубина очереди"""
+        return self._queue.qsize()
+
+    def _put(self, item):
+        if self._stopped:
+            # После остановки пишем сразу, чтобы не потерять данные
+            self._flush([item])
+            return None
+        self._start()
+        if self._queue.full():
+            logging.warning(f'DB WRITER QUEUE IS FULL: {self.qsize()}')
+        self._queue.put(item)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not self._STOP and \
+                    len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            stop = batch[-1] is self._STOP
+            if stop:
+                batch.pop()
+            self._flush(batch)
+            if stop:
+                return None
+
+    def _flush(self, batch):
+        if not batch:
+            return None
+        try:
+            self._write(batch)
+            return None
+        except Exception as e:
+            logging.error(f'DB WRITER FLUSH OF {len(batch)} CHANGES FAILED: '
+                          f'{e}')
+        # Одна ошибочная строка (например, время приема уже удалено) не
+        # должна терять остальные: пишем изменения по одному, каждое
+        # отдельной транзакцией, и теряем только ошибочные
+        lost = 0
+        for item in batch:
+            try:
+                self._write([item])
+            except Exception as e:
+                lost += 1
+                logging.error(f'DB WRITER LOST CHANGE {item}: {e}')
+        if lost:
+            logging.error(f'DB WRITER LOST {lost}/{len(batch)} CHANGES')
+
+    @staticmethod
+    def _write(batch):
+        """Запись изменений одной транзакцией"""
+        records, accept_times, time_zones, alarms = [], {}, {}, []
+        for kind, data in batch:
+            if kind == 'record':
+                records.append(data)
+            elif kind == 'alarm':
+                alarms.append(data)
+            elif kind == 'accept_time':
+                accept_times[data[0]] = data[1]
+            else:
+                time_zones[data[0]] = data[1]
+        write_batch(records, accept_times, time_zones, alarms)
+
+    def stop(self, timeout=30):
+        """Сохранение оставшихся изменений перед завершением"""
+        with self._lock:
+            self._stopped = True
+            thread = self._thread
+        if thread and thread.is_alive():
+            self._queue.put(self._STOP)
+            thread.join(timeout)
+        # То, что успели добавить во время остановки
+        rest = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not self._STOP:
+                rest.append(item)
+        self._flush(rest)
+        logging.info('DB WRITER STOPPED')
+
+
+db_writer = DBWriter(
+    batch_size=int(get_from_env('DB_WRITER_BATCH_SIZE', '200')),
+    flush_interval=float(get_from_env('DB_WRITER_FLUSH_INTERVAL', '1')),
+    max_size=int(get_from_env('DB_WRITER_QUEUE_SIZE', '10000'))
+)
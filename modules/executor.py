@@ -0,0 +1,110 @@
+import logging
+import queue
+import threading
+import time
+
+from tools.tools import get_from_env
+
+
+class BackgroundExecutor:
+    """
+    Общий пул потоков для фоновой работы пользователей (регистрация,
+    восстановление уведомлений, проверка ответов).
+    Количество потоков и длина очереди ограничены: при переполнении
+    вызывающий поток ждет, а не создает новый поток на каждое событие.
+    """
+    _STOP = object()
+
+    def __init__(self, name: str, workers: int, max_size: int):
+        self.name = name
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stopped = False
+
+        self._submitted = 0
+        self._done = 0
+        self._failed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._run_total = 0.0
+
+    def submit(self, fn, *args, **kwargs) -> None:
+        # Задача из потока пула или после остановки выполняется сразу,
+        # иначе вложенные задачи могут ждать друг друга в полной очереди
+        if self._stopped or getattr(self._local, 'worker', False):
+            self._execute(fn, args, kwargs, time.perf_counter())
+            return None
+        self._start()
+        if self._queue.full():
+            logging.warning(f'{self.name.upper()} QUEUE IS FULL: '
+                            f'{self._queue.qsize()}')
+        with self._lock:
+            self._submitted += 1
+        self._queue.put((fn, args, kwargs, time.perf_counter()))
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return None
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run,
+                                          name=f'{self.name}-{i}',
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        self._local.worker = True
+        while (item := self._queue.get()) is not self._STOP:
+            self._execute(*item)
+
+    def _execute(self, fn, args, kwargs, submitted):
+        start = time.perf_counter()
+        try:
+            fn(*args, **kwargs)
+            failed = 0
+        except Exception:
+            logging.exception(f'{self.name.upper()} TASK {fn.__name__} FAILED')
+            failed = 1
+        finished = time.perf_counter()
+        with self._lock:
+            self._done += 1
+            self._failed += failed
+            self._wait_total += start - submitted
+            self._wait_max = max(self._wait_max, start - submitted)
+            self._run_total += finished - start
+
+    def stop(self, timeout: float = 30) -> None:
+        """Выполняем задачи из очереди и останавливаем потоки"""
+        with self._lock:
+            threads, self._stopped = self._threads, True
+        for _ in threads:
+            self._queue.put(self._STOP)
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        logging.info(f'{self.name.upper()} EXECUTOR STOPPED: {self.stats()}')
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'queue': self._queue.qsize(),
+                'submitted': self._submitted,
+                'done': self._done,
+                'failed': self._failed,
+                'wait_avg_ms': round(self._wait_total / self._done * 1000, 3)
+                if self._done else 0.0,
+                'wait_max_ms': round(self._wait_max * 1000, 3),
+                'run_avg_ms': round(self._run_total / self._done * 1000, 3)
+                if self._done else 0.0,
+            }
+
+
+background = BackgroundExecutor(
+    name='background',
+    workers=int(get_from_env('BACKGROUND_WORKERS', '4')),
+    max_size=int(get_from_env('BACKGROUND_QUEUE_SIZE', '1000')),
+)
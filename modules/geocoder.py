@@ -0,0 +1,147 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+import requests
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+
+from tools.exceptions import GeocoderError
+from tools.tools import get_from_env
+
+DEFAULT_GEOCODER_URL = 'http://geocode-maps.yandex.ru/1.x/'
+
+
+def normalize_query(query: str) -> str:
+    """Один и тот же адрес, набранный по-разному, дает один ключ кэша"""
+    return ' '.join(query.lower().replace('ё', 'е').split()).strip(' .,')
+
+
+class Geocoder:
+    """
+    Клиент геокодера.
+    Соединения переиспользуются (requests.Session), запросы ограничены
+    таймаутом. Результаты кэшируются в памяти и в sqlite файле на диске,
+    поэтому повторный поиск того же адреса не обращается к геокодеру.
+    """
+
+    def __init__(self, url: str, timeout: float, cache_size: int,
+                 cache_ttl: int, cache_path: Optional[str],
+                 api_key: Optional[str] = None):
+        self.url = url
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self._api_key = api_key
+        self._session = requests.Session()
+        self._session.mount('http://', HTTPAdapter(pool_maxsize=8))
+        self._session.mount('https://', HTTPAdapter(pool_maxsize=8))
+        self._lock = threading.Lock()
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._cache_path = cache_path
+        self._db = None
+
+    @property
+    def api_key(self) -> str:
+        # Ключ читаем один раз, а не при каждом запросе
+        if self._api_key is None:
+            self._api_key = get_from_env('GEOCODER_T')
+        return self._api_key
+
+    def find(self, query: str) -> Optional[Tuple[str, str]]:
+        """Координаты (долгота, широта) адреса или None, если не найден"""
+        key = normalize_query(query)
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+            found, result = self._disk_get(key)
+            if found:
+                self._cache[key] = result
+                return result
+
+        result = self._request(query)
+        with self._lock:
+            self._cache[key] = result
+            self._disk_set(key, result)
+        return result
+
+    def _request(self, query: str) -> Optional[Tuple[str, str]]:
+        try:
+            response = self._session.get(self.url, params={
+                'apikey': self.api_key,
+                'format': 'json',
+                'geocode': query
+            }, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise GeocoderError(f'Ошибка запроса ({e.__class__.__name__})')
+        if not response:
+            raise GeocoderError(f'Http статус: {response.status_code} '
+                                f'({response.reason})')
+
+        collection = response.json()['response']['GeoObjectCollection']
+        if collection['metaDataProperty'][
+                'GeocoderResponseMetaData']['found'] == '0':
+            return None
+        toponym = collection['featureMember'][0]['GeoObject']
+        longitude, latitude = toponym['Point']['pos'].split(' ')
+        return longitude, latitude
+
+    def _connect(self):
+        if self._db is None and self._cache_path:
+            os.makedirs(os.path.dirname(self._cache_path) or '.',
+                        exist_ok=True)
+            self._db = sqlite3.connect(self._cache_path,
+                                       check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS geocoder_cache ('
+                             'query TEXT PRIMARY KEY, lon TEXT, lat TEXT, '
+                             'created REAL)')
+        return self._db
+
+    def _disk_get(self, key) -> Tuple[bool, Optional[Tuple[str, str]]]:
+        try:
+            db = self._connect()
+            if db is None:
+                return False, None
+            row = db.execute('SELECT lon, lat FROM geocoder_cache '
+                             'WHERE query = ? AND created > ?',
+                             (key, time.time() - self.cache_ttl)).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f'GEOCODER CACHE READ ERROR: {e}')
+            return False, None
+        if row is None:
+            return False, None
+        # Адрес, который не был найден, хранится без координат
+        return True, (row[0], row[1]) if row[0] is not None else None
+
+    def _disk_set(self, key, result) -> None:
+        try:
+            db = self._connect()
+            if db is None:
+                return
+            lon, lat = result if result else (None, None)
+            with db:
+                db.execute('INSERT OR REPLACE INTO geocoder_cache '
+                           'VALUES (?, ?, ?, ?)', (key, lon, lat, time.time()))
+        except sqlite3.Error as e:
+            logging.warning(f'GEOCODER CACHE WRITE ERROR: {e}')
+
+
+geocoder = Geocoder(
+    url=get_from_env('GEOCODER_URL', DEFAULT_GEOCODER_URL),
+    timeout=float(get_from_env('GEOCODER_TIMEOUT', '5')),
+    cache_size=int(get_from_env('GEOCODER_CACHE_SIZE', '1024')),
+    cache_ttl=int(get_from_env('GEOCODER_CACHE_TTL', str(30 * 24 * 3600))),
+    cache_path=os.path.join('static', 'geocoder_cache.sqlite'),
+)
+
+
+def get_geocoder() -> Geocoder:
+    return geocoder
+
+
+def set_geocoder(new_geocoder: Geocoder) -> None:
+    """Замена геокодера (например, на локальный сервер для тестов)"""
+    global geocoder
+    geocoder = new_geocoder
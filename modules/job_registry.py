@@ -0,0 +1,55 @@
+import logging
+import threading
+
+from apscheduler.events import EVENT_JOB_REMOVED
+from telegram.ext import Job, JobQueue
+
+
+class JobRegistry:
+    """
+    Индекс задач JobQueue по имени.
+    JobQueue.get_jobs_by_name перебирает все задачи планировщика, а поиск
+    выполняется при каждом уведомлении, ответе и изменении настроек.
+    Индекс обновляется при добавлении задачи, а при удалении и завершении
+    задачи - по событию EVENT_JOB_REMOVED планировщика APScheduler.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_name = {}  # {имя: {id задачи APScheduler: задача}}
+        self._names = {}  # {id задачи APScheduler: имя}
+
+    def start(self, job_queue: JobQueue) -> None:
+        job_queue.scheduler.add_listener(self._on_removed, EVENT_JOB_REMOVED)
+
+    def add(self, job: Job) -> Job:
+        with self._lock:
+            self._by_name.setdefault(job.name, {})[job.job.id] = job
+            self._names[job.job.id] = job.name
+        return job
+
+    def get(self, name) -> list:
+        with self._lock:
+            return list(self._by_name.get(name, {}).values())
+
+    def names(self) -> list:
+        with self._lock:
+            return list(self._by_name)
+
+    def _on_removed(self, event) -> None:
+        with self._lock:
+            name = self._names.pop(event.job_id, None)
+            if name is None:
+                return
+            jobs = self._by_name.get(name)
+            jobs.pop(event.job_id, None)
+            if not jobs:
+                del self._by_name[name]
+        logging.debug(f'JOB REMOVED FROM REGISTRY: {name}')
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._names)
+
+
+job_registry = JobRegistry()
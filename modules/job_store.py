@@ -0,0 +1,62 @@
+import pickle
+
+from apscheduler.job import Job as APSJob
+from apscheduler.jobstores.base import ConflictingIdError, JobLookupError
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.util import datetime_to_utc_timestamp
+from sqlalchemy.exc import IntegrityError
+from telegram.ext import CallbackContext, Dispatcher, Job
+
+
+class PatientJobStore(SQLAlchemyJobStore):
+    """
+    Хранилище задач пациентов JobQueue в бд.
+    Аргумент задачи JobQueue - CallbackContext с диспетчером, который
+    нельзя сохранить. Поэтому в бд хранится только имя задачи и ее данные
+    (chat_id и имя уведомления), а CallbackContext создается заново
+    при загрузке задачи из бд.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, shared_engine=False,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.dispatcher = dispatcher
+        self.shared_engine = shared_engine
+
+    def _dumps(self, job: APSJob) -> bytes:
+        state = job.__getstate__()
+        tg_job = job.args[0].job
+        state['args'] = (tg_job.name, tg_job.context)
+        return pickle.dumps(state, self.pickle_protocol)
+
+    def add_job(self, job: APSJob):
+        insert = self.jobs_t.insert().values(
+            id=job.id,
+            next_run_time=datetime_to_utc_timestamp(job.next_run_time),
+            job_state=self._dumps(job)
+        )
+        try:
+            self.engine.execute(insert)
+        except IntegrityError:
+            raise ConflictingIdError(job.id)
+
+    def update_job(self, job: APSJob):
+        update = self.jobs_t.update().values(
+            next_run_time=datetime_to_utc_timestamp(job.next_run_time),
+            job_state=self._dumps(job)
+        ).where(self.jobs_t.c.id == job.id)
+        if self.engine.execute(update).rowcount == 0:
+            raise JobLookupError(job.id)
+
+    def _reconstitute_job(self, job_state):
+        job = super()._reconstitute_job(job_state)
+        name, context = job.args
+        tg_job = Job(job.func, context=context, name=name,
+                     job_queue=self.dispatcher.job_queue, job=job)
+        job.args = (CallbackContext.from_job(tg_job, self.dispatcher),)
+        return job
+
+    def shutdown(self):
+        # Пул соединений бота закрывать нельзя, он еще нужен при выходе
+        if not self.shared_engine:
+            super().shutdown()
@@ -1,4 +1,3 @@
-import requests
 from telegram import (KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove,
                       Update, error)
 from telegram.ext import (CallbackContext, CallbackQueryHandler,
@@ -8,11 +7,15 @@ from telegram.ext import (CallbackContext, CallbackQueryHandler,
 from modules.dialogs_shortcuts.start_shortcuts import (
     CONF_LOCATION, END, PATIENT_REGISTRATION_ACTION, START_OVER,
     START_SELECTORS, STOPPING)
+from modules.geocoder import get_geocoder
+from modules.persistence import PERSISTENT_DIALOGS
+from tools.exceptions import GeocoderError
 from tools.prepared_answers import BAD_GEOCODER_RESP
-from tools.tools import get_from_env
 
 
 class Location:
+    __slots__ = ('_time_zone', '_location')
+
     def __init__(self, tz=None, location: dict = None):
         self._time_zone = self.validate_tz(tz) if tz else tz
         self._location = location  # {'address': [lat, lon]}
@@ -54,10 +57,14 @@ class Location:
 
 
 class FindLocationDialog(ConversationHandler):
+    # Используется при регистрации, где состояние не сохраняется
+    persistent_dialog = False
+
     def __init__(self, *args, **kwargs):
         from modules.start_dialogs import StartDialog
         super().__init__(
             name=self.__class__.__name__,
+            persistent=PERSISTENT_DIALOGS and self.persistent_dialog,
             entry_points=[CallbackQueryHandler(
                 self.start, pattern=f'^{CONF_LOCATION}$')]
             if not kwargs.get('e_points') else kwargs.get('e_points'),
@@ -183,33 +190,19 @@ class FindLocationDialog(ConversationHandler):
         """Поиск локации в яндексе"""
 
         # Получние ответа от геокодера о поиске адреса
-        geocoder_uri = 'http://geocode-maps.yandex.ru/1.x/'
-        response = requests.get(geocoder_uri, params={
-            'apikey': get_from_env('GEOCODER_T'),
-            'format': 'json',
-            'geocode': update.message.text
-        })
-        if not response:
-            update.message.reply_text(
-                BAD_GEOCODER_RESP +
-                f'Http статус: {response.status_code} ({response.reason})')
+        try:
+            coords = get_geocoder().find(update.message.text)
+        except GeocoderError as e:
+            update.message.reply_text(BAD_GEOCODER_RESP + str(e))
             return None
 
-        json_response = response.json()
-
-        # На основе ответа геокодера получаем координаты объекта
-        if json_response['response']['GeoObjectCollection'][
-             'metaDataProperty']['GeocoderResponseMetaData']['found'] == '0':
+        if coords is None:
             update.message.reply_text('Мы не смогли найти указанный адрес. '
                                       'Попробуйте снова.')
             return None
 
-        toponym = json_response['response']['GeoObjectCollection'][
-            'featureMember'][0]['GeoObject']
-        toponym_coodrinates = toponym['Point']['pos']
-
         # Долгота и широта
-        toponym_longitude, toponym_lattitude = toponym_coodrinates.split(' ')
+        toponym_longitude, toponym_lattitude = coords
         delta = '0.3'
         ll = ','.join([toponym_longitude, toponym_lattitude])
         spn = ','.join([delta, delta])
@@ -229,6 +222,8 @@ class FindLocationDialog(ConversationHandler):
 
 
 class ChangeLocationDialog(FindLocationDialog):
+    persistent_dialog = True
+
     def __init__(self):
         from modules.settings_dialogs import SETTINGS_ACTION, SettingsDialog
         super().__init__(
@@ -7,8 +7,12 @@ from telegram.ext import (CallbackContext, CallbackQueryHandler,
 
 from modules.dialogs_shortcuts.notification_shortcuts import *
 from modules.dialogs_shortcuts.start_shortcuts import START_OVER
-from modules.timer import deleting_pre_start_msg_task, remove_job_if_exists
-from tools.decorators import registered_patient
+from modules.executor import background
+from modules.persistence import PERSISTENT_DIALOGS
+from modules.send_queue import INTERACTIVE, REMINDER, send_queue
+from modules.timer import (deleting_pre_start_msg_task, remove_job_if_exists,
+                           run_once)
+from tools.decorators import chat_lock, per_chat, registered_patient
 
 
 class Notification:
@@ -24,7 +28,9 @@ class Notification:
 
         if not context.user_data.get(START_OVER):
             try:
-                msg = update.callback_query.edit_message_text(
+                msg = send_queue.call(
+                    INTERACTIVE, user.chat_id,
+                    update.callback_query.edit_message_text,
                     text=text, reply_markup=keyboard)
             except error.TelegramError:
                 context.user_data[START_OVER] = False
@@ -39,11 +45,13 @@ class Notification:
 
             # Удаляем pre-start сообщение перед началом диалога
             if not user.active_dialog_msg:
-                context.bot.delete_message(user.chat_id,
-                                           user.msg_to_del.message_id)
+                send_queue.call(INTERACTIVE, user.chat_id,
+                                context.bot.delete_message,
+                                user.chat_id, user.msg_to_del.message_id)
             try:
                 # Отправляем новое сообщение
-                msg = context.bot.send_message(
+                msg = send_queue.call(
+                    INTERACTIVE, user.chat_id, context.bot.send_message,
                     user.chat_id, text=text, reply_markup=keyboard)
             except error.Unauthorized:
                 return END
@@ -55,6 +63,7 @@ class PillTakingDialog(ConversationHandler):
     def __init__(self):
         super().__init__(
             name=self.__class__.__name__,
+            persistent=PERSISTENT_DIALOGS,
             conversation_timeout=dt.timedelta(hours=1, minutes=30),
             entry_points=[CallbackQueryHandler(self.start,
                                                pattern=f'^{PILL_TAKING}$')],
@@ -91,26 +100,44 @@ class PillTakingDialog(ConversationHandler):
 
         keyboard = InlineKeyboardMarkup(buttons)
 
-        try:
-            msg = context.bot.send_message(user.chat_id, text=text,
-                                           reply_markup=keyboard)
-            user.msg_to_del = msg
-        except error.Unauthorized:
-            pass
-        except error.BadRequest as e:
-            logging.warning(f'CANT SEND NOTIFICATION TO '
-                            f'PATIENT-{user.chat_id}. '
-                            f'CHAT NOT FOUND. \nMORE: {e}')
+        # Не ждем отправки: задача планировщика не должна занимать поток,
+        # пока очередь отправки соблюдает лимиты. msg_to_del сохраняется
+        # после отправки (_save_msg_to_del)
+        previous = user.msg_to_del
+        send_queue.post(
+            REMINDER, user.chat_id, context.bot.send_message,
+            user.chat_id, text=text, reply_markup=keyboard
+        ).add_done_callback(lambda future: background.submit(
+            PillTakingDialog._save_msg_to_del, user, previous, future))
+
         # Таск на "само-удаление" сообщения
         remove_job_if_exists(f'{user.chat_id}-pre_start_msg', context)
-        context.job_queue.run_once(
+        run_once(
+            context,
             callback=deleting_pre_start_msg_task,
             when=dt.timedelta(hours=1, minutes=30),
-            context={'user': user},
+            data={'chat_id': user.chat_id},
             name=f'{user.chat_id}-pre_start_msg'
         )
 
     @staticmethod
+    def _save_msg_to_del(user, previous, future):
+        """Сохраняем отправленное уведомление под блокировкой чата.
+        Вызывается в общем пуле, а не в потоке очереди отправки: там
+        ожидание блокировки могло бы занять все потоки отправки"""
+        if (e := future.exception()) is not None:
+            if isinstance(e, error.BadRequest):
+                logging.warning(f'CANT SEND NOTIFICATION TO '
+                                f'PATIENT-{user.chat_id}. '
+                                f'CHAT NOT FOUND. \nMORE: {e}')
+            return None
+        with chat_lock(user.chat_id):
+            # Сообщение уже заменено другим уведомлением или диалогом
+            if user.msg_to_del is previous:
+                user.msg_to_del = future.result()
+
+    @staticmethod
+    @per_chat
     @registered_patient
     def start(update: Update, context: CallbackContext):
         response = context.user_data['user'].pill_response
@@ -141,20 +168,26 @@ class PillTakingDialog(ConversationHandler):
         return PILL_TAKING_ACTION
 
     @staticmethod
+    @per_chat
     def confirm(update: Update, context: CallbackContext):
         """Подтверждение принятия лекарства"""
         context.user_data['user'].pill_response = 'Я принял лекарство.'
         return PillTakingDialog.start(update, context)
 
     @staticmethod
+    @per_chat
     def reason(update: Update, context: CallbackContext):
         """Запрашивает у пользователя причину"""
         text = 'Опишите вашу причину'
         if not context.user_data.get(START_OVER):
-            update.callback_query.edit_message_text(text=text)
+            send_queue.call(INTERACTIVE, update.effective_chat.id,
+                            update.callback_query.edit_message_text,
+                            text=text)
         else:
             try:
-                update.effective_chat.send_message(text=text)
+                send_queue.call(INTERACTIVE, update.effective_chat.id,
+                                update.effective_chat.send_message,
+                                text=text)
             except error.Unauthorized:
                 return END
             finally:
@@ -162,6 +195,7 @@ class PillTakingDialog(ConversationHandler):
         return TYPING
 
     @staticmethod
+    @per_chat
     def save_reason(update: Update, context: CallbackContext):
         """Сохранение пользовательского ответа"""
         resp = update.message.text
@@ -174,17 +208,20 @@ class PillTakingDialog(ConversationHandler):
         text = 'Ваш ответ слишком длинный.' \
                '\nВозможное количество символов: 100'
         try:
-            update.message.reply_text(text=text)
+            send_queue.call(INTERACTIVE, update.effective_chat.id,
+                            update.message.reply_text, text=text)
         except error.Unauthorized:
             return END
         return PillTakingDialog.reason(update, context)
 
     @staticmethod
+    @per_chat
     def end(update: Update, context: CallbackContext):
         """Завершение первого утреннего диалога"""
         text = 'Мы сохранили Ваш ответ. Спасибо!'
 
-        update.callback_query.edit_message_text(text=text)
+        send_queue.call(INTERACTIVE, update.effective_chat.id,
+                        update.callback_query.edit_message_text, text=text)
 
         # Переключаем индекс диалога у пользователя из задачи.
         user = context.user_data['user']
@@ -196,13 +233,16 @@ class PillTakingDialog(ConversationHandler):
         return END
 
     @staticmethod
+    @per_chat
     def stop(update: Update, context: CallbackContext):
         user = context.user_data['user']
         # Если сообщение еще не обновилось
         if not Notification.is_msg_updated(user):
             # Если пользователь ввел команду /stop, диалог останавливается.
-            context.bot.delete_message(update.effective_chat.id,
-                                       user.msg_to_del.message_id)
+            send_queue.call(INTERACTIVE, update.effective_chat.id,
+                            context.bot.delete_message,
+                            update.effective_chat.id,
+                            user.msg_to_del.message_id)
             PillTakingDialog.pre_start(context, data={'user': user})
         return END
 
@@ -211,6 +251,7 @@ class DataCollectionDialog(ConversationHandler):
     def __init__(self):
         super().__init__(
             name=self.__class__.__name__,
+            persistent=PERSISTENT_DIALOGS,
             conversation_timeout=dt.timedelta(hours=1, minutes=30),
             entry_points=[CallbackQueryHandler(self.start,
                                                pattern=f'^{DATA_COLLECT}$')],
@@ -246,6 +287,7 @@ class DataCollectionDialog(ConversationHandler):
         PillTakingDialog.pre_start(context, data, text=text, buttons=buttons)
 
     @staticmethod
+    @per_chat
     @registered_patient
     def start(update: Update, context: CallbackContext):
         # Получаем пользователя из задачи
@@ -289,6 +331,7 @@ class DataCollectionDialog(ConversationHandler):
         return DATA_COLLECT_ACTION
 
     @staticmethod
+    @per_chat
     def input_req(update: Update, context: CallbackContext):
         """Запрос у пользователя ввода данных"""
         val = update.callback_query.data \
@@ -302,16 +345,21 @@ class DataCollectionDialog(ConversationHandler):
         else:
             text = 'Введите значение частоты сердечных сокращений (ЧСС)'
         if not context.user_data.get(START_OVER):
-            update.callback_query.edit_message_text(text=text)
+            send_queue.call(INTERACTIVE, update.effective_chat.id,
+                            update.callback_query.edit_message_text,
+                            text=text)
         else:
             try:
-                update.effective_chat.send_message(text=text)
+                send_queue.call(INTERACTIVE, update.effective_chat.id,
+                                update.effective_chat.send_message,
+                                text=text)
             except error.Unauthorized:
                 return END
         context.user_data[START_OVER] = False
         return TYPING
 
     @staticmethod
+    @per_chat
     def save_input(update: Update, context: CallbackContext):
         """Сохранение пользовательских данных"""
         inp = update.message.text
@@ -322,11 +370,13 @@ class DataCollectionDialog(ConversationHandler):
             context.user_data[START_OVER] = True
             return DataCollectionDialog.start(update, context)
         text = 'Данные были введены в неправильном формате.\nПопробуйте снова.'
-        update.message.reply_text(text=text)
+        send_queue.call(INTERACTIVE, update.effective_chat.id,
+                        update.message.reply_text, text=text)
         context.user_data[START_OVER] = True
         return DataCollectionDialog.input_req(update, context)
 
     @staticmethod
+    @per_chat
     def end(update: Update, context: CallbackContext):
         # Получаем пользователя из контекста
         user = context.user_data['user']
@@ -339,7 +389,8 @@ class DataCollectionDialog(ConversationHandler):
 
         text = 'Мы сохранили Ваш ответ. Спасибо!'
 
-        update.callback_query.edit_message_text(text=text)
+        send_queue.call(INTERACTIVE, update.effective_chat.id,
+                        update.callback_query.edit_message_text, text=text)
 
         # Удаляем повторяющийся таск
         remove_job_if_exists(f'{user.chat_id}-rep_task', context)
@@ -349,12 +400,15 @@ class DataCollectionDialog(ConversationHandler):
         return END
 
     @staticmethod
+    @per_chat
     def stop(update: Update, context: CallbackContext):
         user = context.user_data['user']
         # Если сообщение еще не обновилось
         if not Notification.is_msg_updated(user):
-            context.bot.delete_message(update.effective_chat.id,
-                                       user.msg_to_del.message_id)
+            send_queue.call(INTERACTIVE, update.effective_chat.id,
+                            context.bot.delete_message,
+                            update.effective_chat.id,
+                            user.msg_to_del.message_id)
 
             DataCollectionDialog.pre_start(context, data={'user': user})
         return END
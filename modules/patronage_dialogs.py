@@ -1,5 +1,4 @@
 import logging
-from os import remove
 
 from telegram import ReplyKeyboardMarkup, Update, error
 from telegram.ext import (CallbackContext, CallbackQueryHandler,
@@ -11,8 +10,10 @@ from db_api import (change_patients_membership, get_patient_by_user_code,
                     make_patient_list, patient_exists_by_user_code)
 from modules.dialogs_shortcuts.start_shortcuts import (END, EXCLUDE_PATIENT,
                                                        SEND_USER_DATA_PAT)
+from modules.persistence import PERSISTENT_DIALOGS
+from modules.send_queue import EXPORT, send_queue
 from modules.users_list import users_list
-from modules.users_classes import DoctorUser, RegionUser
+from modules.users_classes import DoctorUser, PatientUser, RegionUser
 from tools.decorators import registered_patronages
 
 
@@ -20,6 +21,7 @@ class BaseJob(ConversationHandler):
     def __init__(self):
         super().__init__(
             name=self.__class__.__name__,
+            persistent=PERSISTENT_DIALOGS,
             entry_points=[
                 MessageHandler(Filters.regex('^Получить данные по пациенту$'),
                                self.send_user_file),
@@ -77,14 +79,10 @@ class BaseJob(ConversationHandler):
         #     return END
         if patient_exists_by_user_code(user_code):
             try:
-                make_file_by_patient_user_code(user_code)
-                update.effective_chat.send_document(
-                    open(f'static/{user_code}_data.xlsx', 'rb'))
-                remove(f'static/{user_code}_data.xlsx')
-            except FileNotFoundError as ex:
-                logging.info(ex)
-                update.message.reply_text(
-                    'Файл не найден. Обратитесь к администратору.')
+                with make_file_by_patient_user_code(user_code) as file:
+                    send_queue.call(EXPORT, update.effective_chat.id,
+                                    update.effective_chat.send_document,
+                                    file, filename=f'{user_code}_data.xlsx')
             except error.Unauthorized:
                 return END
             except Exception as ex:
@@ -105,8 +103,15 @@ class BaseJob(ConversationHandler):
         patient = get_patient_by_user_code(user_code)
         try:
             if patient:
+                # Пользователя получаем до исключения: в ленивом режиме
+                # исключенный пациент из бд уже не загружается
+                user = users_list[patient.chat_id]
                 change_patients_membership(user_code)
-                users_list[patient.chat_id].change_membership(context)
+                if user is not None:
+                    user.change_membership(context)
+                else:
+                    PatientUser.remove_jobs(patient.chat_id, context)
+                    users_list.remove(patient.chat_id)
                 logging.info(f'Patient {user_code}-{patient.chat_id} EXCLUDE')
 
                 context.bot.send_message(
@@ -127,9 +132,10 @@ class BaseJob(ConversationHandler):
         data = update.callback_query.data
         user_code = data[data.find('&') + 1:]
         try:
-            make_file_by_patient_user_code(user_code)
-            update.effective_chat.send_document(
-                open(f'static/{user_code}_data.xlsx', 'rb'))
+            with make_file_by_patient_user_code(user_code) as file:
+                send_queue.call(EXPORT, update.effective_chat.id,
+                                update.effective_chat.send_document,
+                                file, filename=f'{user_code}_data.xlsx')
             context.bot.edit_message_reply_markup(
                 update.effective_chat.id, update.effective_message.message_id)
         except error.Unauthorized:
@@ -138,16 +144,12 @@ class BaseJob(ConversationHandler):
     @staticmethod
     @registered_patronages()
     def send_users_data(update: Update, context: CallbackContext):
-        make_file_patients(user_code=context.user_data['user'].code)
         try:
-            update.effective_chat.send_document(
-                open('static/statistics.csv', 'rb'))
-            remove('static/statistics.csv')
-        except FileNotFoundError as ex:
-            logging.info(ex)
-            update.effective_chat.send_message(
-                'Файл не найден. Обратитесь к администратору.'
-            )
+            with make_file_patients(
+                    user_code=context.user_data['user'].code) as file:
+                send_queue.call(EXPORT, update.effective_chat.id,
+                                update.effective_chat.send_document,
+                                file, filename='statistics.csv')
         except error.Unauthorized:
             pass
         except Exception as ex:
@@ -157,16 +159,12 @@ class BaseJob(ConversationHandler):
     @staticmethod
     @registered_patronages()
     def send_patients_list(update: Update, context: CallbackContext):
-        make_patient_list(user_code=context.user_data['user'].code)
         try:
-            update.effective_chat.send_document(
-                open('static/Список пациентов.xlsx', 'rb'))
-            remove('static/Список пациентов.xlsx')
-        except FileNotFoundError as ex:
-            logging.info(ex)
-            update.effective_chat.send_message(
-                'Файл не найден. Обратитесь к администратору.'
-            )
+            with make_patient_list(
+                    user_code=context.user_data['user'].code) as file:
+                send_queue.call(EXPORT, update.effective_chat.id,
+                                update.effective_chat.send_document,
+                                file, filename='Список пациентов.xlsx')
         except error.Unauthorized:
             pass
         except Exception as ex:
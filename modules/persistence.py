@@ -0,0 +1,315 @@
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import Optional
+
+import telegram
+from telegram.ext import BasePersistence, ConversationHandler, JobQueue
+from telegram.ext.utils.promise import Promise
+
+from modules.users_list import users_list
+from tools.tools import get_from_env
+
+# none - состояния диалогов и user_data только в памяти,
+# sqlite - сохраняются в static/persistence.sqlite и переживают перезапуск
+PERSISTENCE = get_from_env('PERSISTENCE', 'none').lower()
+PERSISTENT_DIALOGS = PERSISTENCE == 'sqlite'
+
+# Хранилище опирается на внутренности python-telegram-bot 13.11 (версия
+# закреплена в requirements.txt): BasePersistence.__new__ и
+# JobQueue._update_persistence. Все обращения к ним - в этом модуле,
+# а при их отсутствии бот не запускается (check_ptb_internals)
+PTB_VERSION = '13.11'
+
+
+def check_ptb_internals() -> None:
+    if '__new__' not in vars(BasePersistence) or \
+            not hasattr(JobQueue, '_update_persistence'):
+        raise RuntimeError(
+            f'PERSISTENCE: python-telegram-bot {telegram.__version__} is not '
+            f'supported, SQLitePersistence requires {PTB_VERSION}')
+
+
+def detach_job_queue(job_queue: JobQueue) -> None:
+    """
+    После каждой задачи JobQueue вызывает update_persistence для всех
+    пользователей. Данные пользователя меняются в его обработчиках,
+    поэтому сохраняем их только после обработки обновлений
+    """
+    job_queue.scheduler.remove_listener(job_queue._update_persistence)
+
+
+class UserData(dict):
+    """
+    user_data пользователя.
+    Пользователь ('user') не сохраняется, а берется из users_list при первом
+    обращении. Незавершенный диалог уведомления пациента восстанавливается
+    из снимка, сохраненного до перезапуска.
+    """
+
+    def __init__(self, chat_id, data=(), dialog=None, bot=None):
+        super().__init__(data)
+        self.chat_id = chat_id
+        self._dialog = dialog
+        self._bot = bot
+
+    def __missing__(self, key):
+        if key != 'user' or (user := users_list[self.chat_id]) is None:
+            raise KeyError(key)
+        if self._dialog and hasattr(user, 'restore_dialog_state'):
+            user.restore_dialog_state(self._dialog, self._bot)
+        self._dialog = None
+        self['user'] = user
+        return user
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class UsersData(defaultdict):
+    """dispatcher.user_data: новые записи - UserData"""
+
+    def __init__(self, bot=None):
+        super().__init__()
+        self._bot = bot
+
+    def __missing__(self, key):
+        value = self[key] = UserData(key, bot=self._bot)
+        return value
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Хранение состояний ConversationHandler, user_data и chat_data в sqlite.
+    После обработки обновления запись пользователя только помечается
+    измененной, а в файл измененные записи пишутся отдельным потоком
+    раз в flush_interval секунд и при остановке бота (flush).
+    """
+
+    def __new__(cls, *args, **kwargs):
+        # BasePersistence.__new__ (PTB_VERSION) оборачивает get_*/update_*
+        # в глубокое копирование данных при каждом обновлении. Объекты
+        # с ботом мы не сохраняем, поэтому копирование не нужно
+        return object.__new__(cls)
+
+    def __init__(self, path: str, flush_interval: float,
+                 conversation_ttl: int):
+        super().__init__(store_user_data=True, store_chat_data=True,
+                         store_bot_data=False)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.conversation_ttl = conversation_ttl
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db = None
+        self._users = {}  # {user_id: user_data} - измененные записи
+        self._chats = {}  # {chat_id: chat_data}
+        self._conversations = {}  # {(имя, ключ): состояние}
+        self._loaded = None  # {имя: {ключ: состояние}}
+        self._thread = None
+        self.flushes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.executescript(
+                'CREATE TABLE IF NOT EXISTS user_data ('
+                'user_id INTEGER PRIMARY KEY, data BLOB);'
+                'CREATE TABLE IF NOT EXISTS chat_data ('
+                'chat_id INTEGER PRIMARY KEY, data BLOB);'
+                'CREATE TABLE IF NOT EXISTS conversations ('
+                'name TEXT, key TEXT, state BLOB, updated REAL, '
+                'PRIMARY KEY (name, key));')
+        return self._db
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='persistence', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.warning(f'PERSISTENCE: FLUSH FAILED. MORE: {e}')
+
+    # Загрузка при запуске
+
+    def get_user_data(self) -> UsersData:
+        users = UsersData(self.bot)
+        with self._db_lock:
+            rows = self._connect().execute(
+                'SELECT user_id, data FROM user_data').fetchall()
+        for user_id, data in rows:
+            data = pickle.loads(data)
+            dialog = data.pop('_dialog', None)
+            users[user_id] = UserData(user_id, data, dialog, self.bot)
+        self._start()
+        return users
+
+    def get_chat_data(self) -> defaultdict:
+        chats = defaultdict(dict)
+        with self._db_lock:
+            rows = self._connect().execute(
+                'SELECT chat_id, data FROM chat_data').fetchall()
+        for chat_id, data in rows:
+            chats[chat_id] = pickle.loads(data)
+        return chats
+
+    def get_bot_data(self) -> dict:
+        return {}
+
+    def get_conversations(self, name: str) -> dict:
+        if self._loaded is None:
+            self._loaded = defaultdict(dict)
+            with self._db_lock:
+                db = self._connect()
+                # Диалоги, которые давно не продолжались, не восстанавливаем
+                with db:
+                    db.execute('DELETE FROM conversations WHERE updated < ?',
+                               (time.time() - self.conversation_ttl,))
+                rows = db.execute('SELECT name, key, state '
+                                  'FROM conversations').fetchall()
+            for conv_name, key, state in rows:
+                self._loaded[conv_name][tuple(json.loads(key))] = \
+                    pickle.loads(state)
+        return dict(self._loaded.get(name, {}))
+
+    # Изменения после обработки обновлений
+
+    def update_user_data(self, user_id: int, data: dict) -> None:
+        with self._lock:
+            self._users[user_id] = data
+
+    def update_chat_data(self, chat_id: int, data: dict) -> None:
+        with self._lock:
+            self._chats[chat_id] = data
+
+    def update_bot_data(self, data) -> None:
+        pass
+
+    _PENDING = object()
+
+    @classmethod
+    def _resolve_state(cls, state):
+        """Состояние диалога без Promise (обработчик с run_async).
+        Если обработчик еще выполняется - _PENDING"""
+        if not (isinstance(state, tuple) and len(state) == 2 and
+                isinstance(state[1], Promise)):
+            return state
+        old_state, promise = state
+        if not promise.done.is_set():
+            return cls._PENDING
+        new_state = promise.result()
+        if new_state is None:
+            return cls._resolve_state(old_state)
+        return None if new_state == ConversationHandler.END else new_state
+
+    def update_conversation(self, name: str, key, new_state) -> None:
+        # Состояние с Promise разрешается при записи в файл
+        with self._lock:
+            self._conversations[name, key] = new_state
+
+    def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    @staticmethod
+    def _encode_user_data(data: dict) -> bytes:
+        # Если пользователь еще не обращался к боту после перезапуска,
+        # сохраняем восстановленный снимок диалога
+        dialog = getattr(data, '_dialog', None)
+        data = dict(data)
+        user = data.pop('user', None)
+        if hasattr(user, 'dialog_state'):
+            dialog = user.dialog_state()
+        if dialog:
+            data['_dialog'] = dialog
+        return pickle.dumps(data)
+
+    def flush(self) -> None:
+        """Записываем измененные записи одной транзакцией"""
+        with self._lock:
+            users, self._users = self._users, {}
+            chats, self._chats = self._chats, {}
+            conversations, self._conversations = self._conversations, {}
+        if not (users or chats or conversations):
+            return None
+
+        now = time.time()
+        user_rows = []
+        for user_id, data in users.items():
+            try:
+                user_rows.append((user_id, self._encode_user_data(data)))
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                logging.warning(f'PERSISTENCE: CANT SAVE USER DATA '
+                                f'{user_id}. MORE: {e}')
+        chat_rows = [(chat_id, pickle.dumps(dict(data)))
+                     for chat_id, data in chats.items()]
+        conv_rows, conv_deleted, pending = [], [], {}
+        for (name, key), state in conversations.items():
+            state = self._resolve_state(state)
+            if state is self._PENDING:
+                # Обработчик еще выполняется - запишем при следующем сбросе
+                pending[name, key] = conversations[name, key]
+            elif state is None:
+                conv_deleted.append((name, json.dumps(key)))
+            else:
+                conv_rows.append((name, json.dumps(key), pickle.dumps(state),
+                                  now))
+
+        if pending:
+            with self._lock:
+                for conv, state in pending.items():
+                    self._conversations.setdefault(conv, state)
+
+        with self._db_lock:
+            db = self._connect()
+            with db:
+                db.executemany('INSERT OR REPLACE INTO user_data '
+                               'VALUES (?, ?)', user_rows)
+                db.executemany('INSERT OR REPLACE INTO chat_data '
+                               'VALUES (?, ?)', chat_rows)
+                db.executemany('INSERT OR REPLACE INTO conversations '
+                               'VALUES (?, ?, ?, ?)', conv_rows)
+                db.executemany('DELETE FROM conversations '
+                               'WHERE name = ? AND key = ?', conv_deleted)
+        self.flushes += 1
+        logging.debug(f'PERSISTENCE FLUSHED: {len(user_rows)} users, '
+                      f'{len(chat_rows)} chats, '
+                      f'{len(conv_rows) + len(conv_deleted)} conversations')
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'users': len(self._users), 'chats': len(self._chats),
+                    'conversations': len(self._conversations),
+                    'flushes': self.flushes}
+
+
+def create_persistence() -> Optional[SQLitePersistence]:
+    if not PERSISTENT_DIALOGS:
+        return None
+    check_ptb_internals()
+    return SQLitePersistence(
+        path=os.path.join('static', 'persistence.sqlite'),
+        flush_interval=float(get_from_env('PERSISTENCE_FLUSH_INTERVAL', '5')),
+        conversation_ttl=int(get_from_env('PERSISTENCE_CONVERSATION_TTL',
+                                          str(24 * 3600))),
+    )
@@ -1,19 +1,32 @@
 import logging
+import time
 
 from telegram import Update
 from telegram.ext import CallbackContext
 
-from db_api import (get_accept_times_by_patient_id, get_all_patients,
-                    get_all_doctors, get_all_regions, get_all_uni,
-                    get_patient_by_chat_id)
+from db_api import (get_accept_times_by_patient_id, get_all_doctors,
+                    get_all_regions, get_all_uni, get_doctor_by_chat_id,
+                    get_patient_by_chat_id, get_region_by_chat_id,
+                    get_restore_snapshot, get_university_by_chat_id)
+from modules.timer import has_stored_jobs, remove_stored_jobs_except
 from modules.users_classes import DoctorUser, RegionUser, UniUser
-from modules.users_list import users_list
+from modules.users_list import USERS_LIST_MODE, users_list
+
+# Пользователи загружаются из бд при первом обращении
+LAZY_USERS = USERS_LIST_MODE == 'lazy'
 
 
 class Restore:
     def __init__(self, dispatcher):
         self.context = CallbackContext(dispatcher)
 
+        users_list.configure(
+            loader=self.load_user,
+            # Выгруженный пользователь заново загрузится при обращении
+            on_evict=lambda chat_id: dispatcher.user_data.get(
+                chat_id, {}).pop('user', None)
+        )
+
         # Восстановление всех пациентов, которые зарегистрированны и участвуют
         self.restore_all_patients()
         # Восстановление врачей
@@ -24,12 +37,39 @@ class Restore:
         self.restore_all_uni()
 
     def restore_all_patients(self):
-        for patient in filter(lambda x: x.member, get_all_patients()):
-            accept_times = get_accept_times_by_patient_id(patient.id)
-            self.restore_patient(self.context, patient, accept_times)
+        # Пациенты, их время приема и время последних ответов
+        # загружаются одним снимком, поэтому дальше запросов в бд нет
+        start = time.perf_counter()
+        snapshot = get_restore_snapshot()
+        loaded = time.perf_counter()
+
+        patients = []
+        for patient, accept_times in snapshot:
+            if len(accept_times) < 2:
+                logging.warning(f'PATIENT {patient.chat_id} HAS NO '
+                                f'ACCEPT TIMES. SKIPPED')
+                continue
+            patients.append(self.build_patient(patient, accept_times))
+        built = time.perf_counter()
+
+        # Задачи, загруженные из хранилища (JOB_STORE), не пересоздаем
+        remove_stored_jobs_except({p.chat_id for p in patients},
+                                  self.context)
+        for p in patients:
+            if not has_stored_jobs(p.chat_id):
+                self.restore_patient_jobs(self.context, p)
+            # Задачи хранят только chat_id, поэтому в ленивом режиме
+            # пациент нужен в памяти только при создании задач
+            users_list.release(p.chat_id)
+        scheduled = time.perf_counter()
+
+        logging.info(f'--- {len(patients)} PATIENTS RESTORED --- '
+                     f'load: {loaded - start:.2f}s, '
+                     f'build: {built - loaded:.2f}s, '
+                     f'jobs: {scheduled - built:.2f}s')
 
     @staticmethod
-    def restore_patient(context, patient, accept_times):
+    def build_patient(patient, accept_times):
         from modules.users_classes import PatientUser
 
         p = PatientUser(patient.chat_id)
@@ -39,14 +79,20 @@ class Restore:
             times={'MOR': accept_times[0].time, 'EVE': accept_times[1].time},
             accept_times={'MOR': accept_times[0].id, 'EVE': accept_times[1].id}
         )
-        # Проверяем пациента на время последней записи
-        p.check_user_records(context)
+        return p
 
+    @staticmethod
+    def restore_patient_jobs(context, p):
         # Восстановление обычных Daily тасков
         p.recreate_notification(context)
         # Восстановление цикличных тасков. Если для них соответствует время
         p.restore_repeating_task(context)
 
+    @staticmethod
+    def restore_patient(context, patient, accept_times):
+        p = Restore.build_patient(patient, accept_times)
+        Restore.restore_patient_jobs(context, p)
+
         logging.info(f'--- PATIENT {p.chat_id} RESTORED ---')
 
     @staticmethod
@@ -57,20 +103,72 @@ class Restore:
 
         context.user_data['user'] = users_list[update.effective_user.id]
 
+    @staticmethod
+    def load_user(chat_id, role):
+        """Загрузка пользователя из бд (ленивый режим users_list).
+        Задачи пользователя уже созданы при запуске бота"""
+        if role == 'PatientUser':
+            patient = get_patient_by_chat_id(chat_id)
+            if not patient or not patient.member:
+                return None
+            accept_times = get_accept_times_by_patient_id(patient.id)
+            if len(accept_times) < 2:
+                return None
+            return Restore.build_patient(patient, accept_times)
+        if role == 'DoctorUser':
+            doctor = get_doctor_by_chat_id(chat_id)
+            if not doctor:
+                return None
+            user = DoctorUser(chat_id)
+            user.restore(doctor.doctor_code)
+            return user
+        if role == 'RegionUser':
+            region = get_region_by_chat_id(chat_id)
+            if not region:
+                return None
+            user = RegionUser(chat_id)
+            user.restore(region.region_code)
+            return user
+        if role == 'UniUser':
+            if not get_university_by_chat_id(chat_id):
+                return None
+            user = UniUser(chat_id)
+            user.restore()
+            return user
+        return None
+
     @staticmethod
     def restore_all_doctors():
-        for doctor in get_all_doctors():
-            DoctorUser(doctor.chat_id).restore(doctor.doctor_code)
-            logging.info(f'--- DOCTOR {doctor.chat_id} RESTORED ---')
+        start = time.perf_counter()
+        doctors = get_all_doctors()
+        for doctor in doctors:
+            if LAZY_USERS:
+                users_list.index(doctor.chat_id, 'DoctorUser')
+            else:
+                DoctorUser(doctor.chat_id).restore(doctor.doctor_code)
+        logging.info(f'--- {len(doctors)} DOCTORS RESTORED --- '
+                     f'{time.perf_counter() - start:.2f}s')
 
     @staticmethod
     def restore_all_regions():
-        for region in get_all_regions():
-            RegionUser(region.chat_id).restore(region.region_code)
-            logging.info(f'--- REGION {region.chat_id} RESTORED ---')
+        start = time.perf_counter()
+        regions = get_all_regions()
+        for region in regions:
+            if LAZY_USERS:
+                users_list.index(region.chat_id, 'RegionUser')
+            else:
+                RegionUser(region.chat_id).restore(region.region_code)
+        logging.info(f'--- {len(regions)} REGIONS RESTORED --- '
+                     f'{time.perf_counter() - start:.2f}s')
 
     @staticmethod
     def restore_all_uni():
-        for uni in get_all_uni():
-            UniUser(uni.chat_id).restore()
-            logging.info(f'--- UNI {uni.chat_id} RESTORED ---')
+        start = time.perf_counter()
+        unis = get_all_uni()
+        for uni in unis:
+            if LAZY_USERS:
+                users_list.index(uni.chat_id, 'UniUser')
+            else:
+                UniUser(uni.chat_id).restore()
+        logging.info(f'--- {len(unis)} UNI RESTORED --- '
+                     f'{time.perf_counter() - start:.2f}s')
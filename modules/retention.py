@@ -0,0 +1,43 @@
+import datetime as dt
+import logging
+import time
+
+from telegram.ext import CallbackContext, Dispatcher
+
+from db_api import purge_alarms, purge_excluded_patients
+from modules.users_list import users_list
+from tools.tools import get_from_env
+
+# Пациенты, исключенные RETENTION_MONTHS месяцев назад и раньше и без
+# ответов за это время, удаляются вместе с записями, 0 - не удаляем
+RETENTION_MONTHS = int(get_from_env('RETENTION_MONTHS', '0'))
+RETENTION_CHUNK_SIZE = int(get_from_env('RETENTION_CHUNK_SIZE', '50'))
+# Время запуска очистки (UTC)
+RETENTION_TIME = dt.time.fromisoformat(get_from_env('RETENTION_TIME',
+                                                    '03:00'))
+# Сколько дней храним записи об отправленных оповещениях
+ALARM_RETENTION_DAYS = int(get_from_env('ALARM_RETENTION_DAYS', '30'))
+
+
+def start_retention(dispatcher: Dispatcher):
+    dispatcher.job_queue.run_daily(purge_old_data, time=RETENTION_TIME,
+                                   name='retention')
+
+
+def _forget_users(chat_ids):
+    for chat_id in chat_ids:
+        users_list.remove(chat_id)
+
+
+def purge_old_data(context: CallbackContext):
+    """Ежедневная очистка устаревших данных"""
+    start = time.perf_counter()
+    now = dt.datetime.utcnow()
+    patients = 0
+    if RETENTION_MONTHS:
+        patients = purge_excluded_patients(
+            now - dt.timedelta(days=30 * RETENTION_MONTHS),
+            chunk_size=RETENTION_CHUNK_SIZE, on_deleted=_forget_users)
+    alarms = purge_alarms(now.date() - dt.timedelta(days=ALARM_RETENTION_DAYS))
+    logging.info(f'--- RETENTION: {patients} PATIENTS, {alarms} ALARMS '
+                 f'DELETED --- {time.perf_counter() - start:.2f}s')
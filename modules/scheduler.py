@@ -0,0 +1,201 @@
+import datetime as dt
+import logging
+import threading
+
+import pytz
+from telegram.ext import CallbackContext
+
+MINUTES_IN_DAY = 24 * 60
+
+
+def epoch_minute(time: dt.datetime) -> int:
+    """Номер минуты от начала эпохи (UTC)"""
+    return int(time.timestamp() // 60)
+
+
+class BucketJob:
+    """Задача минутного планировщика.
+    Повторяет ту часть telegram.ext.Job, которая используется в боте"""
+    __slots__ = ('name', 'callback', 'context', 'minute', 'interval', 'last',
+                 'removed', '_scheduler')
+
+    def __init__(self, scheduler, name, callback, context, minute,
+                 interval=None, last=None):
+        self._scheduler = scheduler
+        self.name = name
+        self.callback = callback
+        self.context = context
+        # Минута следующего запуска (UTC, от начала эпохи)
+        self.minute = minute
+        # Для ежедневных и повторяющихся задач - период в минутах
+        self.interval = interval
+        # Минута, после которой повторяющаяся задача завершается
+        self.last = last
+        self.removed = False
+
+    @property
+    def enabled(self) -> bool:
+        return not self.removed
+
+    @property
+    def next_t(self) -> dt.datetime:
+        return dt.datetime.fromtimestamp(self.minute * 60, tz=pytz.utc)
+
+    def schedule_removal(self) -> None:
+        self._scheduler.remove(self.name, self)
+
+
+class MinuteScheduler:
+    """
+    Планировщик с корзинами по минутам.
+    Вместо отдельной задачи APScheduler на каждого пациента задачи
+    складываются в корзины по UTC минуте запуска, а одна задача JobQueue
+    раз в минуту запускает все задачи из наступившей корзины.
+    Добавление, удаление и перенос задачи - O(1).
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._buckets = {}  # {минута: {имя: задача}}
+        self._jobs = {}  # {имя: задача}
+        self._last_tick = None
+        self._dispatcher = None
+
+    def start(self, dispatcher) -> None:
+        """Запуск ежеминутной задачи в JobQueue диспетчера"""
+        self._dispatcher = dispatcher
+        now = dt.datetime.now(pytz.utc)
+        dispatcher.job_queue.run_repeating(
+            callback=self._tick,
+            interval=60,
+            # Срабатываем в начале каждой минуты
+            first=now.replace(second=1, microsecond=0) +
+            dt.timedelta(minutes=1),
+            name='minute-scheduler'
+        )
+        logging.info('MINUTE SCHEDULER STARTED')
+
+    def get(self, name):
+        return self._jobs.get(name)
+
+    def add(self, job: BucketJob) -> BucketJob:
+        with self._lock:
+            self.remove(job.name)
+            # Корзина этой минуты уже обработана
+            if self._last_tick is not None and job.minute <= self._last_tick:
+                job.minute = self._last_tick + 1
+            self._jobs[job.name] = job
+            self._buckets.setdefault(job.minute, {})[job.name] = job
+        return job
+
+    def remove(self, name, job=None) -> bool:
+        with self._lock:
+            current = self._jobs.get(name)
+            if current is None or (job is not None and current is not job):
+                return False
+            del self._jobs[name]
+            bucket = self._buckets.get(current.minute)
+            if bucket is not None:
+                bucket.pop(name, None)
+                if not bucket:
+                    del self._buckets[current.minute]
+            current.removed = True
+            return True
+
+    def run_daily(self, callback, time, name, context,
+                  next_run_time=None) -> BucketJob:
+        """time - локальное время (с tzinfo) ежедневного запуска"""
+        if next_run_time:
+            minute = epoch_minute(next_run_time)
+        else:
+            offset = int(time.utcoffset().total_seconds() // 60) \
+                if time.utcoffset() else 0
+            utc_minute = (time.hour * 60 + time.minute - offset) \
+                % MINUTES_IN_DAY
+            now = epoch_minute(dt.datetime.now(pytz.utc))
+            minute = now - now % MINUTES_IN_DAY + utc_minute
+            if minute <= now:
+                minute += MINUTES_IN_DAY
+        return self.add(BucketJob(self, name, callback, context, minute,
+                                  interval=MINUTES_IN_DAY))
+
+    def run_repeating(self, callback, interval: dt.timedelta, first, last,
+                      name, context) -> BucketJob:
+        """
+        Повторяющаяся задача. Как и в JobQueue, first может быть в прошлом:
+        запуски выравниваются по first + k * interval.
+        last - время (UTC) сегодняшнего дня, после которого задача удаляется
+        """
+        step = int(interval.total_seconds() // 60)
+        now = epoch_minute(dt.datetime.now(pytz.utc))
+        if isinstance(first, dt.timedelta):
+            first = dt.datetime.now(pytz.utc) + first
+        minute = epoch_minute(first)
+        if minute < now:
+            minute += -(-(now - minute) // step) * step
+
+        last_minute = None
+        if last is not None:
+            if isinstance(last, dt.time):
+                last = dt.datetime.combine(
+                    dt.datetime.now(pytz.utc).date(), last,
+                    tzinfo=last.tzinfo or pytz.utc)
+            last_minute = epoch_minute(last)
+            if last_minute < minute:
+                raise ValueError("'last' must not be before 'first'!")
+        return self.add(BucketJob(self, name, callback, context, minute,
+                                  interval=step, last=last_minute))
+
+    def run_once(self, callback, when: dt.timedelta, name,
+                 context) -> BucketJob:
+        run_at = dt.datetime.now(pytz.utc) + when
+        # Округляем вверх до минуты
+        minute = -(-int(run_at.timestamp()) // 60)
+        return self.add(BucketJob(self, name, callback, context, minute))
+
+    def _due_jobs(self, now: int) -> list:
+        """Забираем задачи из наступивших корзин и переносим повторяющиеся"""
+        if self._last_tick is None or now - self._last_tick > MINUTES_IN_DAY:
+            minutes = sorted(m for m in self._buckets if m <= now)
+        else:
+            minutes = range(self._last_tick + 1, now + 1)
+
+        due = []
+        for minute in minutes:
+            bucket = self._buckets.pop(minute, None)
+            if bucket:
+                due.extend(bucket.values())
+        for job in due:
+            del self._jobs[job.name]
+            if job.interval:
+                # Пропущенные запуски не догоняем
+                while job.minute <= now:
+                    job.minute += job.interval
+                if job.last is None or job.minute <= job.last:
+                    self._jobs[job.name] = job
+                    self._buckets.setdefault(job.minute, {})[job.name] = job
+                    continue
+            job.removed = True
+        self._last_tick = now
+        return due
+
+    def _tick(self, context: CallbackContext) -> None:
+        with self._lock:
+            due = self._due_jobs(epoch_minute(dt.datetime.now(pytz.utc)))
+        # Задачи выполняются в потоке планировщика, а не в потоках
+        # диспетчера: они не ждут отправки уведомлений (send_queue.post)
+        # и не должны занимать потоки, нужные обработчикам диалогов
+        for job in due:
+            try:
+                job.callback(CallbackContext.from_job(job, self._dispatcher))
+            except Exception:
+                logging.exception(f'MINUTE SCHEDULER: JOB {job.name} FAILED')
+        if due:
+            logging.info(f'MINUTE SCHEDULER: {len(due)} JOBS STARTED')
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'jobs': len(self._jobs), 'buckets': len(self._buckets)}
+
+
+minute_scheduler = MinuteScheduler()
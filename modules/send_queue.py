@@ -0,0 +1,267 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from telegram import error
+
+from tools.tools import get_from_env
+
+# Очереди (полосы) отправки в порядке приоритета
+INTERACTIVE = 0  # ответы пользователю в диалогах
+REMINDER = 1  # уведомления пациентам
+ALARM = 2  # оповещения врачей и регионов
+EXPORT = 3  # выгрузка файлов
+
+LANES = {INTERACTIVE: 'interactive', REMINDER: 'reminder', ALARM: 'alarm',
+         EXPORT: 'export'}
+
+# Через сколько секунд удаляем из памяти лимиты неактивных чатов
+CHAT_BUCKET_TTL = 60
+
+
+class TokenBucket:
+    """Ограничение частоты: rate токенов в секунду, не более capacity"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до появления токена (0 - токен есть)"""
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+
+class SendTask:
+    __slots__ = ('lane', 'seq', 'chat_id', 'method', 'args', 'kwargs',
+                 'future', 'attempts')
+
+    def __init__(self, lane, seq, chat_id, method, args, kwargs):
+        self.lane = lane
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.attempts = 0
+
+
+class SendQueue:
+    """
+    Очередь исходящих запросов к Telegram API.
+    Все запросы проходят через общий лимит (около 30 сообщений в секунду)
+    и лимит на чат, запросы с меньшим номером очереди отправляются первыми.
+    Если Telegram ответил RetryAfter, отправка приостанавливается
+    на указанное время, а запрос повторяется.
+    Поток очереди и отправители запускаются при первом запросе.
+    """
+
+    def __init__(self, rate: float, chat_rate: float, chat_burst: int,
+                 workers: int, retries: int):
+        self._cond = threading.Condition()
+        self._ready = []  # [(очередь, номер, запрос)]
+        self._delayed = []  # [(время, номер, запрос)]
+        self._seq = itertools.count()
+        self._bucket = TokenBucket(rate, rate)
+        self._chats = {}  # {chat_id: TokenBucket}
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._pause_until = 0.0
+        self._workers = workers
+        self._retries = retries
+        self._tasks = queue.Queue()
+        self._threads = []
+        self._thread = None
+        self._running = False
+        self._pruned = time.monotonic()
+
+        self._depth = dict.fromkeys(LANES, 0)
+        self._sent = 0
+        self._retried = 0
+        self._failed = 0
+
+    def submit(self, lane, chat_id, method, *args, **kwargs) -> Future:
+        """Ставим запрос в очередь. Результат - в возвращаемом Future"""
+        with self._cond:
+            self._start()
+            task = SendTask(lane, next(self._seq), chat_id, method, args,
+                            kwargs)
+            self._depth[lane] += 1
+            heapq.heappush(self._ready, (lane, task.seq, task))
+            self._cond.notify()
+        return task.future
+
+    def call(self, lane, chat_id, method, *args, **kwargs):
+        """Отправка с ожиданием результата.
+        Исключения Telegram пробрасываются так же, как при прямом вызове"""
+        return self.submit(lane, chat_id, method, *args, **kwargs).result()
+
+    def post(self, lane, chat_id, method, *args, **kwargs) -> Future:
+        """Отправка без ожидания, ошибки только пишутся в лог"""
+        future = self.submit(lane, chat_id, method, *args, **kwargs)
+        future.add_done_callback(self._log_error)
+        return future
+
+    @staticmethod
+    def _log_error(future: Future):
+        if future.exception():
+            logging.info(f'SEND QUEUE: REQUEST FAILED. '
+                         f'MORE: {future.exception()}')
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        # Свои daemon-потоки, а не ThreadPoolExecutor: его потоки
+        # останавливаются при выходе раньше, чем очередь успевает
+        # отправить оставшиеся запросы
+        self._threads = [
+            threading.Thread(target=self._work, name=f'send-queue-{i}',
+                             daemon=True)
+            for i in range(self._workers)]
+        for thread in self._threads:
+            thread.start()
+        self._thread = threading.Thread(target=self._run, name='send-queue',
+                                        daemon=True)
+        self._thread.start()
+
+    def _next(self, now: float):
+        """Следующий запрос, который можно отправить,
+        иначе - сколько секунд ждать (None - до нового запроса)"""
+        while self._delayed and self._delayed[0][0] <= now:
+            task = heapq.heappop(self._delayed)[2]
+            heapq.heappush(self._ready, (task.lane, task.seq, task))
+
+        wait = self._delayed[0][0] - now if self._delayed else None
+        if now < self._pause_until:
+            return None, self._pause_until - now
+        if not self._ready:
+            return None, wait
+        bucket_wait = self._bucket.delay(now)
+        if bucket_wait:
+            return None, min(bucket_wait, wait) if wait else bucket_wait
+
+        task = heapq.heappop(self._ready)[2]
+        chat = self._chats.get(task.chat_id)
+        if chat is None:
+            chat = self._chats[task.chat_id] = TokenBucket(self._chat_rate,
+                                                           self._chat_burst)
+        chat_wait = chat.delay(now)
+        if chat_wait:
+            # Чат исчерпал лимит - откладываем, не задерживая другие чаты
+            heapq.heappush(self._delayed, (now + chat_wait, task.seq, task))
+            return None, 0
+        chat.consume()
+        self._bucket.consume()
+        return task, None
+
+    def _prune_chats(self, now: float):
+        if now - self._pruned < CHAT_BUCKET_TTL:
+            return
+        self._pruned = now
+        self._chats = {chat_id: bucket for chat_id, bucket
+                       in self._chats.items()
+                       if now - bucket.updated < CHAT_BUCKET_TTL}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                self._prune_chats(now)
+                task, wait = self._next(now)
+                if task is None:
+                    if wait == 0:
+                        continue
+                    if not self._running and not self._ready and \
+                            not self._delayed:
+                        break
+                    self._cond.wait(wait)
+                    continue
+            self._tasks.put(task)
+
+    def _work(self):
+        while (task := self._tasks.get()) is not None:
+            self._send(task)
+
+    def _send(self, task: SendTask):
+        try:
+            result = task.method(*task.args, **task.kwargs)
+        except error.RetryAfter as e:
+            with self._cond:
+                self._pause_until = max(self._pause_until,
+                                        time.monotonic() + e.retry_after)
+                if task.attempts < self._retries:
+                    logging.warning(f'SEND QUEUE: FLOOD CONTROL, PAUSE FOR '
+                                    f'{e.retry_after} SEC.')
+                    task.attempts += 1
+                    self._retried += 1
+                    self._rewind(task)
+                    heapq.heappush(self._ready, (task.lane, task.seq, task))
+                    self._cond.notify()
+                    return
+                self._failed += 1
+                self._depth[task.lane] -= 1
+            task.future.set_exception(e)
+        except Exception as e:
+            with self._cond:
+                self._failed += 1
+                self._depth[task.lane] -= 1
+            task.future.set_exception(e)
+        else:
+            with self._cond:
+                self._sent += 1
+                self._depth[task.lane] -= 1
+            task.future.set_result(result)
+
+    @staticmethod
+    def _rewind(task: SendTask):
+        """Файлы перед повторной отправкой читаем с начала"""
+        for arg in itertools.chain(task.args, task.kwargs.values()):
+            if hasattr(arg, 'seek'):
+                arg.seek(0)
+
+    def stop(self, timeout: float = 30):
+        """Отправляем оставшиеся запросы и останавливаем очередь"""
+        with self._cond:
+            if self._thread is None:
+                return
+            self._running = False
+            self._cond.notify()
+        self._thread.join(timeout)
+        for _ in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        logging.info(f'SEND QUEUE STOPPED: {self.stats()}')
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = {LANES[lane]: depth for lane, depth in self._depth.items()}
+            stats.update(delayed=len(self._delayed), sent=self._sent,
+                         retried=self._retried, failed=self._failed,
+                         paused=time.monotonic() < self._pause_until)
+            return stats
+
+
+send_queue = SendQueue(
+    rate=float(get_from_env('SEND_RATE', '30')),
+    chat_rate=float(get_from_env('SEND_CHAT_RATE', '1')),
+    chat_burst=int(get_from_env('SEND_CHAT_BURST', '3')),
+    workers=int(get_from_env('SEND_WORKERS', '8')),
+    retries=int(get_from_env('SEND_RETRIES', '3')),
+)
@@ -6,6 +6,7 @@ from telegram.ext import (CallbackContext, CallbackQueryHandler,
 from modules.dialogs_shortcuts.start_shortcuts import (CONF_NOTIFICATIONS,
                                                        CONF_TZ, END,
                                                        START_OVER, STOPPING)
+from modules.persistence import PERSISTENT_DIALOGS
 from modules.start_dialogs import ConfigureNotifTimeDialog, ConfigureTZDialog
 from tools.decorators import registered_patient
 
@@ -20,6 +21,7 @@ class SettingsDialog(ConversationHandler):
     def __init__(self):
         super().__init__(
             name=self.__class__.__name__,
+            persistent=PERSISTENT_DIALOGS,
             entry_points=[MessageHandler(Filters.regex('Настройки$'),
                                          self.start)],
             states={
@@ -153,6 +155,8 @@ class SettingsDialog(ConversationHandler):
 
 
 class SettingsConfNotifTimeDialog(ConfigureNotifTimeDialog):
+    persistent_dialog = True
+
     def __init__(self):
         super().__init__(stop_cb=SettingsDialog.stop_nested)
         self.map_to_parent.update({
@@ -178,6 +182,8 @@ class SettingsConfNotifTimeDialog(ConfigureNotifTimeDialog):
 
 
 class SettingsConfTZDialog(ConfigureTZDialog):
+    persistent_dialog = True
+
     def __init__(self):
         from modules.location import ChangeLocationDialog
         super().__init__(ChangeLocationDialog,
@@ -5,6 +5,7 @@ from telegram.ext import (CallbackContext, CallbackQueryHandler,
 
 from modules.dialogs_shortcuts.start_shortcuts import *
 from modules.patronage_dialogs import DoctorJob, RegionJob, UniJob
+from modules.persistence import PERSISTENT_DIALOGS
 from modules.restore import Restore
 from modules.users_classes import BasicUser, PatientUser, DoctorUser, \
     RegionUser, UniUser
@@ -64,6 +65,8 @@ class StartDialog(ConversationHandler):
     def __init__(self):
         super().__init__(
             name=self.__class__.__name__,
+            # Регистрация не сохраняется между перезапусками: пользователя
+            # еще нет в users_list, и после перезапуска его не восстановить
             entry_points=[CommandHandler('start', self.start)],
             states={
                 START_SELECTORS: [PatientRegistrationDialog(),
@@ -148,6 +151,7 @@ class PatientRegistrationDialog(ConversationHandler):
     def __init__(self):
         super().__init__(
             name=self.__class__.__name__,
+            # Не сохраняется между перезапусками (см. StartDialog)
             entry_points=[CallbackQueryHandler(
                 self.pre_start, pattern=f'^{SIGN_UP_AS_PATIENT}$',
                 run_async=False)],
@@ -355,10 +359,15 @@ class PatientRegistrationDialog(ConversationHandler):
 
 
 class ConfigureTZDialog(ConversationHandler):
+    # Диалог используется и при регистрации, где состояние не сохраняется
+    # (см. StartDialog). В настройках - сохраняется
+    persistent_dialog = False
+
     def __init__(self, loc_d=None, **kwargs):
         from modules.location import FindLocationDialog
         super().__init__(
             name=self.__class__.__name__,
+            persistent=PERSISTENT_DIALOGS and self.persistent_dialog,
             entry_points=[
                 CallbackQueryHandler(self.start, pattern=f'^{CONF_TZ}$')],
             states={
@@ -462,6 +471,10 @@ class ConfigureTZDialog(ConversationHandler):
 
 
 class ConfigureNotifTimeDialog(ConversationHandler):
+    # Диалог используется и при регистрации, где состояние не сохраняется
+    # (см. StartDialog). В настройках - сохраняется
+    persistent_dialog = False
+
     buttons = [
         [
             InlineKeyboardButton(text='-15 мин', callback_data='-15'),
@@ -476,6 +489,7 @@ class ConfigureNotifTimeDialog(ConversationHandler):
         from modules.settings_dialogs import SettingsDialog
         super().__init__(
             name=self.__class__.__name__,
+            persistent=PERSISTENT_DIALOGS and self.persistent_dialog,
             entry_points=[CallbackQueryHandler(
                 self.start, pattern=f'^{CONF_NOTIFICATIONS}$')],
             states={
@@ -593,6 +607,7 @@ class DoctorRegistrationDialog(ConversationHandler):
     def __init__(self, **kwargs):
         super().__init__(
             name=self.__class__.__name__,
+            # Не сохраняется между перезапусками (см. StartDialog)
             entry_points=[CallbackQueryHandler(self.pre_start,
                           pattern=f'^{SIGN_UP_AS_DOCTOR}$'
                           if not kwargs.get('patt') else kwargs['patt'],
@@ -815,6 +830,7 @@ class UniRegistrationDialog(ConversationHandler):
     def __init__(self):
         super().__init__(
             name=self.__class__.__name__,
+            # Не сохраняется между перезапусками (см. StartDialog)
             entry_points=[CallbackQueryHandler(self.pre_start,
                           pattern=f'^{SIGN_UP_AS_UNIVERSITY}$',
                                                run_async=False)],
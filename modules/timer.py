@@ -1,24 +1,166 @@
 import logging
+import os
 import datetime as dt
 from typing import Dict, Optional
 
 import pytz
-from telegram import error
-from telegram.ext import CallbackContext
+from apscheduler.jobstores.base import JobLookupError
+from telegram.ext import CallbackContext, Dispatcher
+
+from modules.job_registry import job_registry
+from modules.scheduler import minute_scheduler
+from modules.send_queue import REMINDER, send_queue
+from modules.users_list import users_list
+from tools.decorators import per_chat
+from tools.tools import get_from_env
+
+# jobs - задачи пациентов в JobQueue (по несколько на пациента),
+# buckets - минутный планировщик с одной задачей в JobQueue
+SCHEDULER_MODE = get_from_env('SCHEDULER_MODE', 'jobs').lower()
+BUCKETS_MODE = SCHEDULER_MODE == 'buckets'
+
+# Хранилище задач пациентов (SCHEDULER_MODE=jobs):
+# memory - в памяти, задачи пересоздаются при каждом запуске,
+# db - в бд бота (DB_ADDRESS), sqlite - в файле static/jobs.sqlite
+JOB_STORE = get_from_env('JOB_STORE', 'memory').lower()
+PERSISTENT_JOBS = not BUCKETS_MODE and JOB_STORE in ('db', 'sqlite')
+PATIENT_JOBSTORE = 'patients'
+# Сколько секунд после запланированного времени еще выполняем
+# опоздавшую задачу
+JOB_MISFIRE_GRACE_TIME = int(get_from_env('JOB_MISFIRE_GRACE_TIME', '3600'))
+
+
+def start_scheduler(dispatcher: Dispatcher):
+    if BUCKETS_MODE:
+        minute_scheduler.start(dispatcher)
+    else:
+        job_registry.start(dispatcher.job_queue)
+        if PERSISTENT_JOBS:
+            start_job_store(dispatcher)
+
+
+def start_job_store(dispatcher: Dispatcher):
+    """Подключаем хранилище задач пациентов и загружаем из него задачи.
+    Планировщик запускается на паузе: пропущенные задачи выполнятся
+    после восстановления пользователей (resume_scheduler)"""
+    from modules.job_store import PatientJobStore
+
+    if JOB_STORE == 'db':
+        from data import db_session
+        db_session.global_init()
+        store = PatientJobStore(dispatcher, shared_engine=True,
+                                engine=db_session.get_engine())
+    else:
+        os.makedirs('static', exist_ok=True)
+        store = PatientJobStore(
+            dispatcher, url=f"sqlite:///{os.path.join('static', 'jobs.sqlite')}")
+
+    scheduler = dispatcher.job_queue.scheduler
+    scheduler.add_jobstore(store, PATIENT_JOBSTORE)
+    scheduler.start(paused=True)
+    for aps_job in scheduler.get_jobs(jobstore=PATIENT_JOBSTORE):
+        job_registry.add(aps_job.args[0].job)
+    logging.info(f'--- {len(job_registry)} JOBS LOADED FROM {JOB_STORE} ---')
+
+
+def resume_scheduler(dispatcher: Dispatcher):
+    if PERSISTENT_JOBS:
+        dispatcher.job_queue.scheduler.resume()
+
+
+def has_stored_jobs(chat_id) -> bool:
+    """Ежедневные задачи пациента загружены из хранилища"""
+    return PERSISTENT_JOBS and bool(job_registry.get(f'{chat_id}-MOR')) and \
+        bool(job_registry.get(f'{chat_id}-EVE'))
+
+
+def remove_stored_jobs_except(chat_ids, context: CallbackContext):
+    """Удаляем из хранилища задачи пациентов, которых больше нет"""
+    if not PERSISTENT_JOBS:
+        return None
+    for name in job_registry.names():
+        if int(name.split('-')[0]) not in chat_ids:
+            remove_job_if_exists(name, context)
+
+
+def _job_kwargs(**kwargs) -> dict:
+    # Пропущенные срабатывания (бот не работал или все потоки JobQueue
+    # заняты, когда у многих пациентов одно время) выполняем один раз.
+    # По умолчанию APScheduler пропускает задачу, опоздавшую на 1 сек.
+    kwargs.update(coalesce=True, misfire_grace_time=JOB_MISFIRE_GRACE_TIME)
+    if PERSISTENT_JOBS:
+        kwargs.update(jobstore=PATIENT_JOBSTORE)
+    return kwargs
+
+
+def scheduler_stats(context: CallbackContext) -> dict:
+    if BUCKETS_MODE:
+        return minute_scheduler.stats()
+    return {'jobs': len(job_registry)}
+
+
+def get_jobs_by_name(name, context: CallbackContext) -> list:
+    if BUCKETS_MODE:
+        job = minute_scheduler.get(name)
+        return [job] if job else []
+    return job_registry.get(name)
 
 
 def remove_job_if_exists(name, context: CallbackContext):
     """Удаляем задачу по имени.
     Возвращаем True если задача была успешно удалена."""
-    current_jobs = context.job_queue.get_jobs_by_name(name)
+    current_jobs = get_jobs_by_name(name, context)
     if not current_jobs:
         return False
     for job in current_jobs:
         logging.info(f'REMOVED TASK: {name}')
-        job.schedule_removal()
+        try:
+            job.schedule_removal()
+        except JobLookupError:
+            # Задача успела завершиться
+            pass
     return True
 
 
+def run_daily(context: CallbackContext, callback, time, name, data,
+              next_run_time=None):
+    if BUCKETS_MODE:
+        return minute_scheduler.run_daily(callback, time, name, data,
+                                          next_run_time)
+    return job_registry.add(context.job_queue.run_daily(
+        callback=callback,
+        time=time,
+        context=data,
+        name=name,
+        job_kwargs=_job_kwargs(next_run_time=next_run_time)
+        if next_run_time else _job_kwargs(),
+    ))
+
+
+def run_repeating(context: CallbackContext, callback, interval, first, last,
+                  name, data):
+    if BUCKETS_MODE:
+        return minute_scheduler.run_repeating(callback, interval, first, last,
+                                              name, data)
+    return job_registry.add(context.job_queue.run_repeating(
+        callback=callback,
+        interval=interval,
+        first=first,
+        last=last,
+        context=data,
+        name=name,
+        job_kwargs=_job_kwargs(),
+    ))
+
+
+def run_once(context: CallbackContext, callback, when, name, data):
+    if BUCKETS_MODE:
+        return minute_scheduler.run_once(callback, when, name, data)
+    return job_registry.add(context.job_queue.run_once(
+        callback=callback, when=when, context=data, name=name,
+        job_kwargs=_job_kwargs()))
+
+
 def calc_start_time(now, first, interval):
     f = dt.timedelta(hours=first.hour, minutes=first.minute)
     n = dt.timedelta(hours=now.hour, minutes=now.minute)
@@ -31,14 +173,12 @@ def restore_repeating_task(user, context: CallbackContext, **kwargs):
     state_name = user.state()[0]
 
     # После регистрации первое утреннее уведомление придет на след. день
-    from db_api import get_all_records_by_accept_time
+    from db_api import has_records
     if user.check_last_record_by_name(state_name)[0] or \
             (state_name == 'MOR' and (
                     kwargs.get('register') or
-                    (not get_all_records_by_accept_time(
-                        user.accept_times['EVE']) and
-                     not get_all_records_by_accept_time(
-                         user.accept_times['MOR'])))):
+                    (not has_records(user.accept_times['EVE']) and
+                     not has_records(user.accept_times['MOR'])))):
         return None
 
     # Проверяем время в которое произошел рестарт.
@@ -56,12 +196,13 @@ def restore_repeating_task(user, context: CallbackContext, **kwargs):
         else dt.timedelta(minutes=30)
 
     remove_job_if_exists(f'{user.chat_id}-rep_task', context)
-    context.job_queue.run_repeating(
+    run_repeating(
+        context,
         callback=repeating_task,
         interval=interval,
         first=calc_start_time(now, first, interval),
         last=last.astimezone(pytz.utc).time(),
-        context={'user': user, 'name': state_name},
+        data={'chat_id': user.chat_id, 'name': state_name},
         name=f'{user.chat_id}-rep_task'
     )
 
@@ -73,46 +214,43 @@ def create_daily_notification(context: CallbackContext, **kwargs):
         # Удаляем старую задачу с таким же именем
         remove_job_if_exists(f'{chat_id}-{kwargs["name"]}', context)
 
-        context.job_queue.run_daily(
+        run_daily(
+            context,
             callback=daily_task,
             time=kwargs['time'],
-            context=kwargs,
+            # В задаче храним только chat_id: пользователь берется из
+            # users_list при срабатывании и может быть выгружен из памяти
+            data={'chat_id': chat_id, 'name': kwargs['name'],
+                  'task_data': kwargs['task_data']},
             name=f'{chat_id}-{kwargs["name"]}',
-            job_kwargs={'next_run_time': kwargs['next_run_time']}
-            if kwargs['next_run_time'] else {},
+            next_run_time=kwargs['next_run_time'],
         )
     except (IndexError, ValueError):
-        try:
-            context.bot.send_message(chat_id, 'Произошла ошибка про попытке '
-                                              'включить таймер. Обратитесь к '
-                                              'администратору')
-        except error.Unauthorized:
-            pass
+        send_queue.post(REMINDER, chat_id, context.bot.send_message,
+                        chat_id, 'Произошла ошибка про попытке '
+                                 'включить таймер. Обратитесь к '
+                                 'администратору')
 
 
+@per_chat
 def daily_task(context: CallbackContext):
     """Таски, которые выполняются ежедневно утром и вечером"""
     from modules.users_classes import PatientUser
     job = context.job
     data: Optional[Dict] = job.context
 
-    user: PatientUser = data['user']
-
-    user.alarmed[data['name']] = False
+    user: PatientUser = users_list[data['chat_id']]
+    if user is None:
+        return None
 
-    user.check_user_records(context)
     user.set_curr_state(data['name'])
     user.clear_responses()
 
     # Если пользователь не ответил на предыдущее сообщение (уведомление),
     # то удаляем его
     if user.msg_to_del:
-        try:
-            context.bot.delete_message(user.chat_id,
-                                       user.msg_to_del.message_id)
-        except Exception as e:
-            logging.info(f'Cant find message id to delete in daily task. '
-                         f'More:{e}')
+        send_queue.post(REMINDER, user.chat_id, context.bot.delete_message,
+                        user.chat_id, user.msg_to_del.message_id)
 
     remove_job_if_exists(f'{user.chat_id}-rep_task', context)
 
@@ -120,52 +258,55 @@ def daily_task(context: CallbackContext):
     if not user.check_last_record_by_name(data['name'])[0]:
         # Создание диалога для сбора данных
         user.notification_states[data['name']][
-            user.state()[1]].pre_start(context, data)
+            user.state()[1]].pre_start(context, {'user': user})
 
         n = dt.datetime.now(tz=user.p_loc.tz).time()
         f = user.p_loc.tz.localize(user.times.time_limiters[data['name']][0])
 
-        context.job_queue.run_repeating(
+        run_repeating(
+            context,
             callback=repeating_task,
             interval=data['task_data']['interval'],
             first=calc_start_time(n, f, data['task_data']['interval']),
             last=data['task_data']['last'],
-            context=data,
+            data={'chat_id': user.chat_id, 'name': data['name']},
             name=f'{user.chat_id}-rep_task'
         )
 
 
+@per_chat
 def repeating_task(context: CallbackContext):
     """Повторяющиеся уведомления в рамках временого лимита"""
     job = context.job
     data: Optional[Dict] = job.context
 
-    user = data['user']
+    user = users_list[data['chat_id']]
+    if user is None:
+        return None
 
     if user.msg_to_del:
-        context.bot.delete_message(user.chat_id, user.msg_to_del.message_id)
+        send_queue.post(REMINDER, user.chat_id, context.bot.delete_message,
+                        user.chat_id, user.msg_to_del.message_id)
 
     user.set_curr_state(data['name'])
-    user.check_user_records(context)
 
     # Запускаем новое уведомление
     user.notification_states[data['name']][user.state()[1]].pre_start(
-        context, data)
+        context, {'user': user})
 
 
+@per_chat
 def deleting_pre_start_msg_task(context: CallbackContext):
     """Удаление сообщения после временного лимита"""
     job = context.job
     data: Optional[Dict] = job.context
-    user = data['user']
-    try:
-        if user.msg_to_del:
-            context.bot.delete_message(user.chat_id, user.msg_to_del.message_id)
-            user.msg_to_del = None
-
-        user.clear_responses()
-        user.save_patient_record()
+    user = users_list[data['chat_id']]
+    if user is None:
+        return None
+    if user.msg_to_del:
+        send_queue.post(REMINDER, user.chat_id, context.bot.delete_message,
+                        user.chat_id, user.msg_to_del.message_id)
+        user.msg_to_del = None
 
-        user.check_user_records(context)
-    except error.TelegramError:
-        remove_job_if_exists(f'{user.chat_id}-pre_start_msg', context)
+    user.clear_responses()
+    user.save_patient_record()
@@ -1,26 +1,29 @@
 import datetime as dt
 import logging
 import re
-from threading import Thread
 from typing import Dict, Tuple
 
 import pytz
-from telegram import Update, error
+from telegram import (Chat, InlineKeyboardButton, InlineKeyboardMarkup,
+                      Message, Update, error)
 from telegram.ext import CallbackContext
 
 from data import db_session
-from db_api import (add_patient, add_doctor, add_record, change_accept_time,
-                    change_patients_time_zone,
-                    get_last_record_by_accept_time, get_patient_by_chat_id,
-                    get_all_records_by_accept_time,
+from db_api import (add_patient, add_doctor,
+                    get_last_response_time, get_patient_by_chat_id,
+                    has_records,
                     get_doctor_by_code,
                     get_region_by_code, get_all_patients_by_user_code,
                     add_region, get_all_doctors_by_user_code, add_university)
+from modules.alarm_ledger import DOCTOR_ALARM, REGION_ALARM, alarm_ledger
+from modules.db_writer import db_writer
+from modules.executor import background
 from modules.location import Location
 from modules.notification_dailogs import DataCollectionDialog, PillTakingDialog
+from modules.send_queue import ALARM, send_queue
 from modules.users_list import users_list
-from modules.timer import (create_daily_notification, remove_job_if_exists,
-                           restore_repeating_task)
+from modules.timer import (create_daily_notification, get_jobs_by_name,
+                           remove_job_if_exists, restore_repeating_task)
 from tools.exceptions import DoctorNotFound, UserExists, RegionNotFound
 from tools.tools import convert_tz
 
@@ -42,7 +45,72 @@ pat_num = r'\d{,10}'
 pat_code = f'{pat_name}{pat_num}'
 
 
+class SlotMap:
+    """Компактная замена небольшого словаря с фиксированными ключами.
+    Ключи - слоты наследника, поэтому у объекта нет __dict__"""
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for key in self.__slots__:
+            setattr(self, key, None)
+        for key, value in zip(self.__slots__, values):
+            setattr(self, key, value)
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        return dict(self.items()) == (dict(other.items())
+                                      if isinstance(other, SlotMap) else other)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def keys(self):
+        return self.__slots__
+
+    def values(self):
+        return [getattr(self, key) for key in self.__slots__]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__slots__]
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+
+class ByNotification(SlotMap):
+    """Значения по типу уведомления"""
+    __slots__ = ('MOR', 'EVE')
+
+
+class DataResponse(SlotMap):
+    """Ответ пациента: давление и ЧСС"""
+    __slots__ = ('sys', 'dias', 'heart')
+
+
+# Все возможные состояния диалога: (имя уведомления, индекс диалога).
+# Кортежи общие для всех пациентов
+STATES = {(name, index): (name, index)
+          for name in ('MOR', 'EVE') for index in (0, 1)}
+
+
 class BasicUser:
+    __slots__ = ('chat_id', 'code', 'is_registered')
+
     USER_EXCLUDED = 0
     USER_IS_PATIENT = 1
     USER_IS_DOCTOR = 2
@@ -75,6 +143,9 @@ class BasicUser:
 
 
 class PatientTimes:
+    """Время уведомлений хранится в минутах от начала дня"""
+    __slots__ = ('MOR', 'EVE', 'orig_mor', 'orig_eve')
+
     # Границы времени уведомлений
     time_limiters = {
         'MOR': [dt.datetime(1212, 12, 12, 6, 00, 0),
@@ -87,40 +158,51 @@ class PatientTimes:
         'MOR': dt.datetime(1212, 12, 12, 8, 00, 0),
         'EVE': dt.datetime(1212, 12, 12, 20, 00, 0)
     }
+    default_minutes = {'MOR': 8 * 60, 'EVE': 20 * 60}
+    # Общие для всех пациентов значения времени по минутам дня
+    day_minutes = tuple(dt.datetime(1212, 12, 12) + dt.timedelta(minutes=m)
+                        for m in range(24 * 60))
 
     def __init__(self, times=None):
         if times:
-            self.times = {k: self.default_times[k].replace(
-                hour=times[k].hour, minute=times[k].minute) for k in
-                times.keys()}
-            self.orig_t = self.times.copy()
+            self.MOR, self.EVE = (times[k].hour * 60 + times[k].minute
+                                  for k in ('MOR', 'EVE'))
+            self.orig_mor, self.orig_eve = self.MOR, self.EVE
         else:
-            self.times = self.default_times.copy()
-            self.orig_t = None
+            self.MOR, self.EVE = self.default_minutes.values()
+            self.orig_mor = self.orig_eve = None
+
+    @property
+    def times(self) -> Dict[str, dt.datetime]:
+        return {k: self[k] for k in ('MOR', 'EVE')}
+
+    @property
+    def orig_t(self):
+        if self.orig_mor is None:
+            return None
+        return {'MOR': self.day_minutes[self.orig_mor],
+                'EVE': self.day_minutes[self.orig_eve]}
 
     def s_times(self):
-        return dict(map(lambda x: (x, self.times[x].strftime("%H:%M")),
-                        self.times.keys()))
+        return {k: f'{v // 60:02}:{v % 60:02}'
+                for k, v in (('MOR', self.MOR), ('EVE', self.EVE))}
 
     def add_minutes(self, time, minutes) -> bool:
         # Добавление минут
-        delta = dt.timedelta(minutes=int(minutes))
-        self.times[time] += delta
+        value = getattr(self, time) + int(minutes)
 
         # Ограничение времени
-        if not (self.default_times[time].replace(
-                hour=self.default_times[time].hour - 1) <= self.times[time] <=
-                self.default_times[time].replace(
-                    hour=self.default_times[time].hour + 1)):
-            self.times[time] -= delta
+        if not (self.default_minutes[time] - 60 <= value <=
+                self.default_minutes[time] + 60):
             return False
+        setattr(self, time, value)
         return True
 
     def drop_times(self):
         """Сброс времени уведомлений до дефолтных"""
-        if self.times == self.default_times:
+        if (self.MOR, self.EVE) == tuple(self.default_minutes.values()):
             return False
-        self.times = self.default_times.copy()
+        self.MOR, self.EVE = self.default_minutes.values()
         return True
 
     def items(self):
@@ -128,28 +210,40 @@ class PatientTimes:
 
     def cancel_updating(self):
         """Возвращает время к изначальным значениям"""
-        self.times = self.orig_t.copy()
+        self.MOR, self.EVE = self.orig_mor, self.orig_eve
 
     def save_updating(self) -> bool:
         """Сохраняем новое время уведомлений"""
-        if self.times != self.orig_t:
-            self.orig_t = self.times.copy()
+        if self.is_updating():
+            self.orig_mor, self.orig_eve = self.MOR, self.EVE
             return True
         return False
 
     def is_updating(self) -> bool:
-        return self.times != self.orig_t
+        return (self.MOR, self.EVE) != (self.orig_mor, self.orig_eve)
 
     def __getitem__(self, item) -> dt.datetime:
-        return self.times[item]
+        return self.day_minutes[getattr(self, item)]
+
+
+# Общий объект Location для каждого часового пояса
+_zone_locations = {}
+
+
+def zone_location(tz) -> Location:
+    location = _zone_locations.get(tz.zone)
+    if location is None:
+        location = _zone_locations[tz.zone] = Location(tz=-int(re.search(
+            pattern=r'[+-]?\d+', string=tz.zone).group(0)))
+    return location
 
 
 class PatientLocation:
+    __slots__ = ('tz', 'location', 'orig_loc')
+
     def __init__(self, tz=None):
         self.tz = tz
-        self.location = self.orig_loc = Location(tz=-int(re.search(
-            pattern=r'[+-]?\d+', string=self.tz.zone).group(0))
-            if tz else None) if tz else None
+        self.location = self.orig_loc = zone_location(tz) if tz else None
 
     def cancel_updating(self) -> None:
         """Возвращает местоположение в оригинальное"""
@@ -160,8 +254,7 @@ class PatientLocation:
         if self.location != self.orig_loc:
             self.tz = pytz.timezone(convert_tz(self.location.get_coords(),
                                                self.location.time_zone()))
-            self.orig_loc = self.location = Location(tz=-int(re.search(
-                pattern=r'[+-]?\d+', string=self.tz.zone).group(0)))
+            self.orig_loc = self.location = zone_location(self.tz)
             return True
         return False
 
@@ -188,6 +281,10 @@ class PatientUser(BasicUser):
     doctor_pat = f'^{region_code}({doctor_code}){pat_code}$'
     region_pat = f'^({region_code}){doctor_code}{pat_code}$'
 
+    __slots__ = ('member', 'accept_times', 'doctor_id', 'p_loc', 'times',
+                 'msg_to_del', 'active_dialog_msg', 'curr_state',
+                 'pill_response', 'data_response')
+
     def __init__(self, chat_id: int):
         super().__init__(chat_id)
         self.member = True
@@ -202,14 +299,12 @@ class PatientUser(BasicUser):
         # при обновлении уведомления.
         self.msg_to_del = self.active_dialog_msg = None
 
-        self.alarmed = {'MOR': False, 'EVE': False}
-
         # Текущее состояние диалога
-        self.curr_state = []  # [name, index]
+        self.curr_state = ()  # (name, index)
 
         # Ответы от пользователя на уведомления
         self.pill_response = None
-        self.data_response = {'sys': None, 'dias': None, 'heart': None}
+        self.data_response = DataResponse()
 
     def set_code(self, code):
         """Проверка пользовательского кода на соответствие формату при вводе"""
@@ -256,9 +351,13 @@ class PatientUser(BasicUser):
     def change_membership(self, context: CallbackContext):
         """Для исключения пациента из исследования"""
         self.member = False
+        self.remove_jobs(self.chat_id, context)
 
-        for task in (f'{self.chat_id}-MOR', f'{self.chat_id}-EVE',
-                     f'{self.chat_id}-rep_task'):
+    @staticmethod
+    def remove_jobs(chat_id, context: CallbackContext):
+        """Удаляем уведомления пациента (в т.ч. не загруженного в память)"""
+        for task in (f'{chat_id}-MOR', f'{chat_id}-EVE',
+                     f'{chat_id}-rep_task'):
             remove_job_if_exists(task, context)
 
     def create_notification(self, context: CallbackContext, **kwargs):
@@ -274,12 +373,9 @@ class PatientUser(BasicUser):
             if self.check_last_record_by_name(name)[0] or \
                     (name == 'MOR' and (
                     kwargs.get('register') or (
-                    not get_all_records_by_accept_time(
-                        self.accept_times['EVE']) and
-                    not get_all_records_by_accept_time(
-                        self.accept_times['MOR'])))) or \
-                    context.job_queue.get_jobs_by_name(
-                        f'{self.chat_id}-rep_task'):
+                    not has_records(self.accept_times['EVE']) and
+                    not has_records(self.accept_times['MOR'])))) or \
+                    get_jobs_by_name(f'{self.chat_id}-rep_task', context):
                 # Утреннее уведомление переносим на день вперед
                 next_r_time = now.replace(
                     hour=time.hour, minute=time.minute, second=0,
@@ -326,7 +422,7 @@ class PatientUser(BasicUser):
 
     def set_curr_state(self, name: str):
         """Устанавливает новое состояние"""
-        self.curr_state = [name, 0]
+        self.curr_state = STATES[name, 0]
 
     def _set_curr_state_by_time(self):
         # Устанавливаем состояние диалога исходя из текущего времени
@@ -339,11 +435,43 @@ class PatientUser(BasicUser):
 
     def next_curr_state_index(self):
         """Переключает индекс текущего состояния"""
-        self.curr_state[1] = min(1, self.curr_state[1] + 1)
+        self.curr_state = STATES[self.curr_state[0], 1]
 
     def clear_responses(self):
         self.pill_response = None
-        self.data_response = {'sys': None, 'dias': None, 'heart': None}
+        self.data_response = DataResponse()
+
+    def dialog_state(self):
+        """Незавершенный диалог уведомления (сохраняется при перезапуске)"""
+        if not (self.msg_to_del or self.active_dialog_msg):
+            return None
+        return {
+            'curr_state': self.curr_state,
+            'pill_response': self.pill_response,
+            'data_response': self.data_response.values(),
+            'msg_to_del': self.msg_to_del.message_id
+            if self.msg_to_del else None,
+            'active_dialog_msg': self.active_dialog_msg.message_id
+            if self.active_dialog_msg else None,
+        }
+
+    def restore_dialog_state(self, state, bot):
+        """Восстановление незавершенного диалога после перезапуска бота"""
+        def message(message_id):
+            if message_id is None:
+                return None
+            return Message(message_id, dt.datetime.now(pytz.utc),
+                           Chat(self.chat_id, Chat.PRIVATE), bot=bot)
+
+        if state['curr_state']:
+            self.curr_state = STATES[tuple(state['curr_state'])]
+        self.pill_response = state['pill_response']
+        self.data_response = DataResponse(*state['data_response'])
+        self.msg_to_del = message(state['msg_to_del'])
+        # Одно и то же сообщение - один объект, как до перезапуска
+        self.active_dialog_msg = self.msg_to_del \
+            if state['active_dialog_msg'] == state['msg_to_del'] \
+            else message(state['active_dialog_msg'])
 
     def cancel_updating(self):
         """Возвращение значений времени и ЧП к начальным значениям"""
@@ -363,25 +491,21 @@ class PatientUser(BasicUser):
             self._set_curr_state_by_time()
 
             if check_user:
-                Thread(target=self._threading_save_sett,
-                       args=(ch_times, ch_tz)).start()
+                self._save_sett(ch_times, ch_tz)
 
             # Восстанавливливаем уведомления
-            Thread(target=self._thr_restore_notifications, args=(context,),
-                   kwargs={'register': not check_user}).start()
-
-            # Проверка ответов пользователя. Т.с. защита от махинаций
-            self.check_user_records(context)
+            background.submit(self._thr_restore_notifications, context,
+                              register=not check_user)
 
-    def _threading_save_sett(self, ch_times, ch_tz):
-        """Сохранение новых настроек в бд"""
+    def _save_sett(self, ch_times, ch_tz):
+        """Сохранение новых настроек в бд (через очередь записи)"""
         if ch_times:
-            change_accept_time(self.accept_times['MOR'],
-                               self.times['MOR'].time())
-            change_accept_time(self.accept_times['EVE'],
-                               self.times['EVE'].time())
+            db_writer.change_accept_time(self.accept_times['MOR'],
+                                         self.times['MOR'].time())
+            db_writer.change_accept_time(self.accept_times['EVE'],
+                                         self.times['EVE'].time())
         if ch_tz:
-            change_patients_time_zone(self.chat_id, self.p_loc.tz.zone)
+            db_writer.change_time_zone(self.chat_id, self.p_loc.tz.zone)
 
     def restore(self, code: str, times: Dict[str, dt.time], tz_str: str,
                 accept_times):
@@ -394,20 +518,21 @@ class PatientUser(BasicUser):
         self.p_loc = PatientLocation(tz=pytz.timezone(tz_str))
         self.times = PatientTimes(times)
 
-        self.accept_times = accept_times
+        self.accept_times = ByNotification(accept_times['MOR'],
+                                           accept_times['EVE'])
 
         self._set_curr_state_by_time()
 
     def enable_user(self, context: CallbackContext):
         """Восстановление пользователя, после разблокировки им бота"""
-        Thread(target=self._threading_enable, args=(context,)).start()
+        background.submit(self._threading_enable, context)
 
     def _threading_enable(self, context: CallbackContext):
         """Восстанавливаем пользователя, если он отключал бота"""
-        if not context.job_queue.get_jobs_by_name(f'{self.chat_id}-MOR'):
+        if not get_jobs_by_name(f'{self.chat_id}-MOR', context):
             self.recreate_notification(context)
-        if not context.job_queue.get_jobs_by_name(f'{self.chat_id}-rep_task'):
-            if self.state() and get_all_records_by_accept_time(
+        if not get_jobs_by_name(f'{self.chat_id}-rep_task', context):
+            if self.state() and has_records(
                     self.accept_times[self.state()[0]]):
                 self.restore_repeating_task(context)
 
@@ -416,7 +541,7 @@ class PatientUser(BasicUser):
         super().register()
         logging.info(f'REGISTER NEW USER: '
                      f'{update.effective_user.id} - {self.code}')
-        Thread(target=self._threading_reg, args=(update, context)).start()
+        background.submit(self._threading_reg, update, context)
 
     def _threading_reg(self, update: Update, context: CallbackContext):
         # Добавляем пациента в список пациентов
@@ -438,11 +563,8 @@ class PatientUser(BasicUser):
 
     def save_patient_record(self):
         """Сохранение результатов ответа на уведомления"""
-        self.alarmed[self.state()[0]] = False
-        Thread(target=self._threading_save_record).start()
-
-    def _threading_save_record(self):
-        add_record(
+        # Ответ фиксируем сразу, т.к. после вызова ответы очищаются
+        db_writer.add_record(
             time_zone=self.p_loc.tz.zone,
             time=self.times[self.state()[0]].time(),
             response_time=dt.datetime.now(self.p_loc.tz),
@@ -455,46 +577,6 @@ class PatientUser(BasicUser):
             else self.pill_response
         )
 
-    def check_user_records(self, context: CallbackContext):
-        # Если аларм у пользователя уже сработал, то заново не активируем
-        if any(self.alarmed.values()) or not self.accept_times:
-            return None
-        Thread(target=self._thread_check_user_records, args=(context,)).start()
-
-    def _thread_check_user_records(self, context: CallbackContext):
-        mor_record = self.check_last_record_by_name('MOR')
-        eve_record = self.check_last_record_by_name('EVE')
-
-        # Если есть какие-либо записи и время ответа >= 25 часов
-        if (not mor_record[0] and mor_record[1] >= 25) or \
-                (not eve_record[0] and eve_record[1] >= 25):
-            self.alarmed['MOR' if mor_record[1] >= 25 else "EVE"] = True
-
-            # Количество дней без ответа от пациента
-            days = int(mor_record[1] / 24) if self.alarmed['MOR'] \
-                else int(eve_record[1] / 24)
-
-            # Получаем ФИО врача и номер региона, чтобы взять врача из бд
-            doc = re.findall(self.doctor_pat, self.code)[0]
-            region = re.findall(self.region_pat, self.code)[0]
-
-            # Ежедневное уведомление для доктора
-            DoctorUser.send_alarm(
-                context=context,
-                user=self,
-                doctor_code=region + doc,
-                days=days
-            )
-
-            # Еженедельное уведомление для региона
-            if not days % 7:
-                RegionUser.send_alarm(
-                    context=context,
-                    user=self,
-                    region_code=region,
-                    days=days
-                )
-
     def check_last_record_by_name(self, name) -> Tuple[bool, int]:
         """
         Получение из бд времени последнего ответа по названию типа уведомления
@@ -502,17 +584,64 @@ class PatientUser(BasicUser):
         :return: True if all right and last record time less than 24 hour
         :return: False if last record time more then 24 hour
         """
-        recs = get_last_record_by_accept_time(self.accept_times[name])
+        response_time = get_last_response_time(self.accept_times[name])
         hours = 24
-        if recs:
-            rec_t: dt.datetime = recs[-1].response_time.astimezone(
-                self.p_loc.tz)
+        if response_time:
+            rec_t: dt.datetime = response_time.astimezone(self.p_loc.tz)
             now = dt.datetime.now(tz=self.p_loc.tz)
             hours = abs(now - rec_t).total_seconds() // 3600
             return now.date() == rec_t.date(), hours
         return False, hours
 
 
+def _alarm_message(code: str, days: int):
+    """Текст и клавиатура оповещения о пациенте без ответа"""
+    text = f'❗️ Внимание ❗️\n' \
+           f'В течении суток пациент {code} не принял ' \
+           f'лекарство/не отправил данные давления и ЧСС.\n' \
+           f'Дней без ответа: {days}'
+    kb = InlineKeyboardMarkup(
+        [[InlineKeyboardButton(
+            'Получить данные о пациенте',
+            callback_data=f'A_PATIENT_DATA&{code}')]],
+        one_time_keyboard=True)
+    return text, kb
+
+
+def _send_alarms(context: CallbackContext, alarms, kind, receiver_code,
+                 get_receiver) -> int:
+    """
+    Отправка оповещений о пациентах без ответа через очередь запросов.
+    Получатель ищется в бд один раз на код, оповещения, которые за этот
+    день уже отправлены (в т.ч. до перезапуска), пропускаются
+    :param alarms: [{'chat_id', 'code', 'days', 'day'}, ...]
+    :param receiver_code: код получателя по коду пациента
+    :param get_receiver: получатель (врач, регион) по коду
+    :return: количество отправленных оповещений
+    """
+    receivers = {}
+    sent = 0
+    for alarm in alarms:
+        try:
+            code = receiver_code(alarm['code'])
+        except IndexError:
+            logging.warning(f'CANT SEND ALARM. WRONG PATIENT CODE: '
+                            f'{alarm["code"]}')
+            continue
+        if code not in receivers:
+            receivers[code] = get_receiver(code)
+        receiver = receivers[code]
+        if not receiver or not alarm_ledger.claim(
+                alarm['chat_id'], kind, alarm['day'], alarm['days']):
+            continue
+        text, kb = _alarm_message(alarm['code'], alarm['days'])
+        # Ошибки отправки (бот заблокирован и т.п.) пишутся в лог
+        send_queue.post(ALARM, receiver.chat_id, context.bot.send_message,
+                        receiver.chat_id, text, reply_markup=kb)
+        sent += 1
+    return sent
+
+
 class DoctorUser(BasicUser):
     # Паттыерн для вроверки формата кода
     code_pat = f'^{region_code}{doctor_code}$'
@@ -565,7 +694,7 @@ class DoctorUser(BasicUser):
     def register(self, update: Update, context: CallbackContext):
         super().register()
         logging.info(f'REGISTER NEW DOCTOR: {update.effective_user.id}')
-        Thread(target=self._threading_reg).start()
+        background.submit(self._threading_reg)
 
     def restore(self, code):
         super().register()
@@ -582,31 +711,14 @@ class DoctorUser(BasicUser):
         )
 
     @staticmethod
-    def send_alarm(context, **kwargs):
-        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-
-        user = kwargs['user']
-        doctor = get_doctor_by_code(kwargs['doctor_code'])
-        if doctor:
-            text = f'❗️ Внимание ❗️\n' \
-                   f'В течении суток пациент {user.code} не принял ' \
-                   f'лекарство/не отправил данные давления и ЧСС.\n' \
-                   f'Дней без ответа: {kwargs["days"]}'
-
-            kb = InlineKeyboardMarkup(
-                [[InlineKeyboardButton(
-                    'Получить данные о пациенте',
-                    callback_data=f'A_PATIENT_DATA&{user.code}')]],
-                one_time_keyboard=True)
-            try:
-                context.bot.send_message(doctor.chat_id, text,
-                                         reply_markup=kb)
-            except error.Unauthorized:
-                pass
-            except Exception as e:
-                logging.warning(f'CANT SEND ALARM TO '
-                                f'DOCTOR-{kwargs["doctor_code"]}. '
-                                f'CHAT NOT FOUND. \nMORE: {e}')
+    def send_alarms(context, alarms) -> int:
+        """Ежедневные оповещения врачам о пациентах без ответа"""
+        return _send_alarms(
+            context, alarms, DOCTOR_ALARM,
+            # Код врача - номер региона и ФИО врача из кода пациента
+            lambda code: re.findall(PatientUser.region_pat, code)[0] +
+            re.findall(PatientUser.doctor_pat, code)[0],
+            get_doctor_by_code)
 
 
 class RegionUser(BasicUser):
@@ -630,7 +742,7 @@ class RegionUser(BasicUser):
     def register(self, update: Update, context: CallbackContext):
         super().register()
         logging.info(f'REGISTER NEW REGION: {update.effective_user.id}')
-        Thread(target=self._threading_reg).start()
+        background.submit(self._threading_reg)
 
     def restore(self, code):
         super().register()
@@ -642,39 +754,20 @@ class RegionUser(BasicUser):
 
         add_region(chat_id=self.chat_id, region_code=self.code)
 
-    @classmethod
-    def send_alarm(cls, context, **kwargs):
-        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-
-        user = kwargs['user']
-        region = get_region_by_code(kwargs['region_code'])
-        if region:
-            text = f'❗️ Внимание ❗️\n' \
-                   f'В течении суток пациент {user.code} не принял ' \
-                   f'лекарство/не отправил данные давления и ЧСС.\n' \
-                   f'Дней без ответа: {kwargs["days"]}'
-
-            kb = InlineKeyboardMarkup(
-                [[InlineKeyboardButton(
-                    'Получить данные о пациенте',
-                    callback_data=f'A_PATIENT_DATA&{user.code}')]],
-                one_time_keyboard=True)
-            try:
-                context.bot.send_message(region.chat_id, text,
-                                         reply_markup=kb)
-            except error.Unauthorized:
-                pass
-            except Exception as e:
-                logging.warning(f'CANT SEND ALARM TO '
-                                f'REGION-{kwargs["region_code"]}. '
-                                f'CHAT NOT FOUND. \nMORE: {e}')
+    @staticmethod
+    def send_alarms(context, alarms) -> int:
+        """Еженедельные оповещения регионам о пациентах без ответа"""
+        return _send_alarms(
+            context, alarms, REGION_ALARM,
+            lambda code: re.findall(PatientUser.region_pat, code)[0],
+            get_region_by_code)
 
 
 class UniUser(BasicUser):
     def register(self, update: Update, context: CallbackContext):
         super().register()
         logging.info(f'REGISTER NEW UNI: {update.effective_user.id}')
-        Thread(target=self._threading_reg).start()
+        background.submit(self._threading_reg)
 
     def restore(self):
         super().register()
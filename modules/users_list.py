@@ -1,3 +1,16 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from tools.tools import get_from_env
+
+# eager - все пользователи загружаются при запуске бота,
+# lazy - при запуске загружается только индекс chat_id -> роль,
+# а пользователи загружаются из бд при первом обращении
+USERS_LIST_MODE = get_from_env('USERS_LIST_MODE', 'eager').lower()
+
+
 class UsersList(dict):
     def __setitem__(self, key, value):
         if self[key]:
@@ -7,5 +20,175 @@ class UsersList(dict):
     def __getitem__(self, item):
         return super().get(item)
 
+    def configure(self, loader=None, on_evict=None) -> None:
+        pass
+
+    def index(self, chat_id, role) -> None:
+        pass
+
+    def release(self, chat_id) -> None:
+        pass
+
+    def touch(self, chat_id) -> None:
+        pass
+
+    def remove(self, chat_id) -> None:
+        """Пользователь удален из бд или исключен"""
+        self.pop(chat_id, None)
+
+    def stats(self) -> dict:
+        return {'users': len(self)}
+
+
+class LazyUsersList(UsersList):
+    """
+    Список пользователей с ленивой загрузкой.
+    В памяти хранится индекс chat_id -> роль и не более max_size
+    пользователей. Остальные загружаются из бд через loader при первом
+    обращении (сообщение пользователя или задача) и вытесняются,
+    если к ним не обращались idle_ttl секунд или список переполнен.
+    Пользователи с неотвеченным уведомлением не вытесняются.
+    """
+
+    def __init__(self, max_size: int, idle_ttl: int):
+        super().__init__()
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._lock = threading.RLock()
+        self._roles = {}  # {chat_id: роль}
+        self._used = OrderedDict()  # {chat_id: время обращения}
+        self._loader = None
+        self._on_evict = None
+        self.loads = 0
+        self.evictions = 0
+
+    def configure(self, loader=None, on_evict=None) -> None:
+        """loader(chat_id, role) - загрузка пользователя из бд,
+        on_evict(chat_id) - вызывается после вытеснения пользователя"""
+        self._loader = loader
+        self._on_evict = on_evict
+
+    def index(self, chat_id, role) -> None:
+        with self._lock:
+            self._roles[chat_id] = role
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if dict.get(self, key):
+                return None
+            dict.__setitem__(self, key, value)
+            self._roles[key] = value.__class__.__name__
+            self._use(key)
+        self._evict()
+
+    def __getitem__(self, item):
+        with self._lock:
+            user = dict.get(self, item)
+            if user is not None:
+                self._use(item)
+                return user
+            role = self._roles.get(item)
+        if role is None or self._loader is None:
+            return None
+
+        # Загрузка из бд идет без блокировки списка
+        loaded = self._loader(item, role)
+        with self._lock:
+            # Пользователь мог быть добавлен при загрузке (restore)
+            # или другим потоком
+            user = dict.get(self, item)
+            if user is None:
+                if loaded is None:
+                    # Пользователь удален или исключен - убираем из индекса
+                    self._roles.pop(item, None)
+                    return None
+                user = loaded
+                dict.__setitem__(self, item, user)
+            self.loads += 1
+            self._use(item)
+        self._evict()
+        return user
+
+    def get(self, key, default=None):
+        user = self[key]
+        return default if user is None else user
+
+    def __contains__(self, item):
+        return dict.__contains__(self, item) or item in self._roles
+
+    def touch(self, chat_id) -> None:
+        """Отмечаем активность пользователя (без загрузки из бд)"""
+        with self._lock:
+            if dict.__contains__(self, chat_id):
+                self._use(chat_id)
+
+    def release(self, chat_id) -> None:
+        """Выгружаем пользователя, который больше не нужен в памяти"""
+        with self._lock:
+            if dict.__contains__(self, chat_id):
+                dict.__delitem__(self, chat_id)
+                self._used.pop(chat_id, None)
+
+    def remove(self, chat_id) -> None:
+        """Пользователь удален из бд или исключен - убираем его и из индекса"""
+        with self._lock:
+            dict.pop(self, chat_id, None)
+            self._used.pop(chat_id, None)
+            self._roles.pop(chat_id, None)
+        if self._on_evict:
+            self._on_evict(chat_id)
+
+    def _use(self, chat_id) -> None:
+        self._used[chat_id] = time.monotonic()
+        self._used.move_to_end(chat_id)
+
+    @staticmethod
+    def _busy(user) -> bool:
+        # Пациент не ответил на уведомление или находится в диалоге
+        return bool(getattr(user, 'msg_to_del', None) or
+                    getattr(user, 'active_dialog_msg', None))
+
+    def _evict(self) -> None:
+        evicted = []
+        with self._lock:
+            now = time.monotonic()
+            busy = []
+            while self._used:
+                chat_id, used = next(iter(self._used.items()))
+                if len(self._used) + len(busy) <= self.max_size and \
+                        now - used < self.idle_ttl:
+                    break
+                self._used.popitem(last=False)
+                user = dict.get(self, chat_id)
+                if self._busy(user):
+                    busy.append((chat_id, used))
+                    continue
+                dict.pop(self, chat_id, None)
+                evicted.append(chat_id)
+            # Занятых пользователей возвращаем в начало очереди
+            for chat_id, used in reversed(busy):
+                self._used[chat_id] = used
+                self._used.move_to_end(chat_id, last=False)
+            self.evictions += len(evicted)
+
+        if self._on_evict:
+            for chat_id in evicted:
+                try:
+                    self._on_evict(chat_id)
+                except Exception as e:
+                    logging.warning(f'USERS LIST: EVICT HOOK FAILED '
+                                    f'FOR {chat_id}. MORE: {e}')
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'users': dict.__len__(self), 'index': len(self._roles),
+                    'loads': self.loads, 'evictions': self.evictions}
+
 
-users_list = UsersList()
+if USERS_LIST_MODE == 'lazy':
+    users_list = LazyUsersList(
+        max_size=int(get_from_env('USERS_LIST_MAX_SIZE', '10000')),
+        idle_ttl=int(get_from_env('USERS_LIST_IDLE_TTL', '7200')),
+    )
+else:
+    users_list = UsersList()
@@ -1,15 +1,41 @@
 from telegram.ext import CallbackContext
 
+from modules.db_writer import db_writer
+from modules.executor import background
+from modules.send_queue import send_queue
 from modules.users_classes import PatientUser
 from modules.users_list import users_list
 
 
 def clear_all_notification(context: CallbackContext):
+    # С PERSISTENCE=sqlite незавершенный диалог сохраняется вместе с
+    # user_data пользователя и восстанавливается после перезапуска,
+    # поэтому его сообщения не удаляем
+    user_data = context.dispatcher.user_data \
+        if context.dispatcher.persistence else {}
     for user in users_list.values():
         try:
+            data = user_data.get(user.chat_id)
+            if data is not None and dict.get(data, 'user') is user:
+                continue
             if type(user) is PatientUser and user.msg_to_del:
                 context.bot.delete_message(user.chat_id,
                                            user.msg_to_del.message_id)
         except Exception as e:
             print(e)
     print('ALL MSG-NOTIFICATION DELETED')
+
+
+def flush_db_writer():
+    """Сохраняем в бд все ответы, которые еще в очереди"""
+    db_writer.stop()
+
+
+def stop_background():
+    """Дожидаемся фоновых задач пользователей"""
+    background.stop()
+
+
+def stop_send_queue():
+    """Отправляем запросы, которые еще в очереди"""
+    send_queue.stop()
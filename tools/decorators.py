@@ -1,8 +1,52 @@
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, RLock
+
 from telegram import Update, error
 from telegram.ext import CallbackContext
 
 from modules.users_list import users_list
 
+# Блокировки по chat_id: работа с одним пользователем из задач и
+# обработчиков выполняется по очереди, а с разными - параллельно.
+# У каждого чата своя блокировка, поэтому ожидание ответа Telegram API
+# (лимит ~1 запрос в сек. на чат) задерживает только этот чат.
+# Блокировка удаляется, когда ее больше никто не ждет
+_chat_locks = {}  # {chat_id: [блокировка, число владельцев и ожидающих]}
+_chat_locks_guard = Lock()
+
+
+@contextmanager
+def chat_lock(chat_id):
+    with _chat_locks_guard:
+        entry = _chat_locks.get(chat_id)
+        if entry is None:
+            entry = _chat_locks[chat_id] = [RLock(), 0]
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _chat_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _chat_locks[chat_id]
+
+
+def per_chat(func):
+    """Выполнение обработчика (update, context) или задачи (context)
+    под блокировкой чата пользователя"""
+    @wraps(func)
+    def decorated_func(*args, **kwargs):
+        if isinstance(args[0], Update):
+            chat_id = args[0].effective_chat.id
+        else:
+            chat_id = args[0].job.context['chat_id']
+        with chat_lock(chat_id):
+            return func(*args, **kwargs)
+
+    return decorated_func
+
 
 def not_registered_users(func):
     def decorated_func(update: Update, context: CallbackContext,
@@ -8,3 +8,7 @@ class RegionNotFound(Exception):
 
 class DoctorNotFound(Exception):
     pass
+
+
+class GeocoderError(Exception):
+    pass
@@ -2,6 +2,10 @@ import argparse
 import base64
 import logging
 import os
+import re
+import threading
+from datetime import datetime, timedelta
+from functools import lru_cache
 
 from dotenv import load_dotenv
 
@@ -10,47 +14,87 @@ def create_token(token):
     return str(base64.b64encode(token.encode("utf-8")))[2:-1]
 
 
-def get_from_env(item):
+def get_from_env(item, default=None):
+    """Значение из .env (в base64). Если передан default и переменной нет,
+    то возвращаем default вместо завершения работы"""
     try:
         path = os.path.join(os.getcwd(), '.env')
         if os.path.exists(path):
             load_dotenv(path)
+        if default is not None and os.environ.get(item) is None:
+            return default
         return base64.b64decode(os.environ.get(item)).decode('utf-8')
     except Exception as ex:
         logging.error(f'Probably not found .env file\nEXCEPTION: {ex}')
         exit(0)
 
 
-def convert_tz(coords=None, tz_offset=None) -> str:
-    from datetime import datetime, timedelta
+_etc_zones = None
+_tz_finder = None
+_tz_lock = threading.Lock()
+
+
+def _etc_zone_table() -> dict:
+    """Таблица {смещение от UTC: зона Etc/GMT±N}, строится один раз"""
+    global _etc_zones
+    if _etc_zones is None:
+        import pytz
+
+        table = {}
+        for zone in sorted(pytz.all_timezones_set):
+            if re.match(r'^Etc/GMT[+-]\d+$', zone):
+                offset = pytz.timezone(zone).utcoffset(datetime.utcnow())
+                table.setdefault(offset, zone)
+        _etc_zones = table
+    return _etc_zones
+
+
+def _get_tz_finder():
+    """Общий TimezoneFinder: данные полигонов загружаются один раз"""
+    global _tz_finder
+    with _tz_lock:
+        if _tz_finder is None:
+            import timezonefinder
 
+            _tz_finder = timezonefinder.TimezoneFinder(in_memory=True)
+    return _tz_finder
+
+
+@lru_cache(maxsize=4096)
+def _timezone_at(lat, lon) -> str:
+    # Координаты округлены, поэтому соседние адреса попадают в кэш
+    return _get_tz_finder().certain_timezone_at(lat=lat, lng=lon)
+
+
+def convert_tz(coords=None, tz_offset=None) -> str:
     import pytz
-    import timezonefinder
 
-    now = datetime.now(pytz.utc)
     if coords and not tz_offset:
         lat, lon = coords
-        tf = timezonefinder.TimezoneFinder()
-        timezone = pytz.timezone(tf.certain_timezone_at(lat=lat, lng=lon))
-        all_tz = list(
-            {tz.zone for tz in map(pytz.timezone, pytz.all_timezones_set)
-             if now.astimezone(tz).utcoffset() == now.astimezone(
-                timezone).utcoffset() and tz.zone.startswith('Etc/')})
-        return all_tz[0]
+        # Координаты из геокодера приходят строками
+        timezone = pytz.timezone(_timezone_at(round(float(lat), 3),
+                                              round(float(lon), 3)))
+        utc_offset = datetime.now(pytz.utc).astimezone(timezone).utcoffset()
     else:
         utc_offset = timedelta(hours=int(tz_offset))
-        all_tz = list(
-            {tz.zone for tz in map(pytz.timezone, pytz.all_timezones_set)
-             if now.astimezone(tz).utcoffset() == utc_offset
-             and tz.zone.startswith('Etc/')})
-        return all_tz[0]
+    try:
+        return _etc_zone_table()[utc_offset]
+    except KeyError:
+        # Для смещений не кратных часу зоны Etc нет
+        raise IndexError(f'No Etc zone for offset {utc_offset}')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-T', '--token',
                         help='convert a token into an encrypted token')
+    parser.add_argument('-B', '--backfill', action='store_true',
+                        help='recalculate last response time and record '
+                             'count of accept times')
 
     args = parser.parse_args()
     if args.token:
         print(create_token(args.token))
+    if args.backfill:
+        from db_api import backfill_accept_time_stats
+        print(f'{backfill_accept_time_stats()} accept times updated')